@@ -0,0 +1,292 @@
+import argparse
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from capture import LatestSlot
+from gallery_snapshot import ensure_snapshot, open_snapshot, snapshot_version
+from startup import worker_context
+import detection
+
+# Per-worker state, set up once by _init_worker
+_worker = {}
+
+# Seconds between checks for registrations and deletions: by the engine for the
+# database, by each worker for a new snapshot version
+DB_CHECK_INTERVAL = 5.0
+
+
+def _init_worker(snapshot_dir, detect_scale):
+    _worker['snapshot_dir'] = snapshot_dir
+    _worker['policy'] = detection.DetectionPolicy(mode='fixed', scale=detect_scale)
+    _worker['version'] = None
+    _worker['checked_at'] = 0.0
+    _refresh_gallery()
+    if _worker['version'] is None:
+        raise RuntimeError(f"No gallery snapshot in {snapshot_dir}")
+
+
+def _refresh_gallery():
+    # Only the engine writes snapshots; a worker just maps the newest one. Every
+    # worker maps the same files, so the OS page cache holds one copy
+    version = snapshot_version(_worker['snapshot_dir'])
+    if version is not None and version != _worker['version']:
+        gallery, meta = open_snapshot(_worker['snapshot_dir'])
+        if gallery is not None:
+            _worker['gallery'] = gallery
+            _worker['version'] = meta['version']
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+def _recognize(frame, tolerance):
+    """Worker task: detect, encode and match one BGR frame against the shared gallery"""
+    now = time.monotonic()
+    if now - _worker['checked_at'] > DB_CHECK_INTERVAL:
+        _worker['checked_at'] = now
+        _refresh_gallery()
+
+    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    boxes = _worker['policy'].detect(rgb)
+    if not boxes:
+        return []
+    encodings = detection.encode_crops(rgb, boxes)
+
+    results = []
+    for box, neighbours in zip(boxes, _worker['gallery'].search(encodings, k=1)):
+        if neighbours and neighbours[0][1] <= tolerance:
+            results.append((box, neighbours[0][0], neighbours[0][1]))
+        else:
+            results.append((box, None, None))
+    return results
+
+
+def _parse_source(source):
+    return int(source) if isinstance(source, str) and source.isdigit() else source
+
+
+class _Stream:
+    def __init__(self, index, source):
+        self.index = index
+        self.source = source
+        self.cap = cv2.VideoCapture(_parse_source(source))
+        self.slot = LatestSlot()
+        self.inflight = False
+        self.captured = 0
+        self.processed = 0
+        self.faces = 0
+        self.started = None
+        self.thread = threading.Thread(target=self._read_loop, name=f'access-stream-{index}', daemon=True)
+
+    def _read_loop(self):
+        while True:
+            ret, frame = self.cap.read()
+            if not ret:
+                break
+            self.captured += 1
+            self.slot.put(frame)
+        self.cap.release()
+        self.slot.close()
+
+    @property
+    def finished(self):
+        return self.slot.closed and not self.slot.pending and not self.inflight
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return {
+            'stream': self.index,
+            'source': str(self.source),
+            'captured_frames': self.captured,
+            'processed_frames': self.processed,
+            'dropped_frames': self.slot.dropped,
+            'processed_fps': round(self.processed / elapsed, 2) if elapsed > 0 else 0.0,
+            'faces_seen': self.faces
+        }
+
+
+class AccessEngine:
+    """
+    Recognition for many gate cameras at once.
+
+    Each stream has a reader thread that keeps only its newest frame. A single
+    scheduler hands frames to a pool of worker processes round-robin, with at
+    most one frame per stream in flight, so a busy or high-FPS camera cannot
+    starve the others. Workers memory-map one shared gallery snapshot; the
+    engine rewrites it when users are registered or deleted while it runs, and
+    the workers re-map the new version. Matches become
+    entry events, de-duplicated per (stream, user) within `cooldown` seconds.
+    """
+
+    def __init__(self, sources, db_path='face_recognition.db', workers=None, tolerance=0.6,
+                 detect_scale=0.25, cooldown=30.0):
+        self.db_path = db_path
+        self.tolerance = tolerance
+        self.cooldown = cooldown
+        self.workers = workers or os.cpu_count() or 1
+        self.events = queue.Queue()
+        self._done = queue.Queue()
+        self._last_entry = {}
+        self._names = {}
+        self._running = False
+
+        # The engine is the only writer of the snapshot; workers just map it
+        self.snapshot_dir = ensure_snapshot(db_path)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=worker_context(),
+            initializer=_init_worker, initargs=(self.snapshot_dir, detect_scale)
+        )
+        # Start every worker now: the pool only forks on first submit, and a fork
+        # taken after the captures are open and the reader threads are running
+        # would copy those half-way through a read
+        for future in [self._executor.submit(_worker_ready) for _ in range(self.workers)]:
+            future.result()
+        self.streams = [_Stream(i, source) for i, source in enumerate(sources)]
+
+    def _user_name(self, user_id):
+        if user_id not in self._names:
+            conn = sqlite3.connect(self.db_path)
+            row = conn.execute("SELECT name FROM users WHERE id = ?", (user_id,)).fetchone()
+            conn.close()
+            self._names[user_id] = row[0] if row else None
+        return self._names[user_id]
+
+    def _on_done(self, stream, future):
+        self._done.put((stream, future))
+
+    def _handle_result(self, stream, future):
+        stream.inflight = False
+        stream.processed += 1
+        try:
+            results = future.result()
+        except Exception as e:
+            print(f"Error recognizing frame from stream {stream.index}: {str(e)}")
+            return
+
+        now = time.time()
+        stream.faces += len(results)
+        for box, user_id, distance in results:
+            if user_id is None:
+                continue
+            key = (stream.index, user_id)
+            if now - self._last_entry.get(key, 0.0) < self.cooldown:
+                continue
+            self._last_entry[key] = now
+            self.events.put({
+                'event': 'entry',
+                'stream': stream.index,
+                'source': str(stream.source),
+                'user_id': user_id,
+                'name': self._user_name(user_id),
+                'distance': round(distance, 4),
+                'box': list(box),
+                'timestamp': now
+            })
+
+    def _schedule(self):
+        inflight = 0
+        next_stream = 0
+        while self._running:
+            # Round-robin over streams that have a fresh frame and nothing in flight
+            for offset in range(len(self.streams)):
+                if inflight >= self.workers:
+                    break
+                stream = self.streams[(next_stream + offset) % len(self.streams)]
+                if stream.inflight or not stream.slot.pending:
+                    continue
+                frame = stream.slot.get(timeout=0)
+                if frame is None:
+                    continue
+                stream.inflight = True
+                inflight += 1
+                future = self._executor.submit(_recognize, frame, self.tolerance)
+                future.add_done_callback(lambda f, s=stream: self._on_done(s, f))
+                next_stream = (stream.index + 1) % len(self.streams)
+
+            try:
+                stream, future = self._done.get(timeout=0.005)
+            except queue.Empty:
+                if all(s.finished for s in self.streams):
+                    break
+                continue
+            inflight -= 1
+            self._handle_result(stream, future)
+
+        self._running = False
+        self.events.put(None)
+
+    def _watch_database(self):
+        """Rewrite the snapshot once the users table changes, for the workers to re-map"""
+        # PRAGMA data_version on this connection moves only when another one commits
+        conn = sqlite3.connect(self.db_path)
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        try:
+            while self._running:
+                time.sleep(DB_CHECK_INTERVAL)
+                current = conn.execute("PRAGMA data_version").fetchone()[0]
+                if current == data_version:
+                    continue
+                try:
+                    ensure_snapshot(self.db_path)
+                except RuntimeError as e:
+                    # Changed again mid-write; data_version stays, so the next check retries
+                    print(f"Gallery snapshot not refreshed: {str(e)}")
+                    continue
+                data_version = current
+        finally:
+            conn.close()
+
+    def start(self):
+        self._running = True
+        for stream in self.streams:
+            stream.started = time.monotonic()
+            stream.thread.start()
+        self._scheduler = threading.Thread(target=self._schedule, name='access-scheduler', daemon=True)
+        self._scheduler.start()
+        threading.Thread(target=self._watch_database, name='access-snapshot', daemon=True).start()
+        return self
+
+    def iter_events(self):
+        """Entry events as they happen; ends when every stream has finished"""
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            yield event
+
+    def stop(self):
+        self._running = False
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'streams': [stream.stats() for stream in self.streams]
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Venue access recognition over several camera streams")
+    parser.add_argument('sources', nargs='+', help="camera indexes, RTSP URLs or video files")
+    parser.add_argument('--workers', type=int, help="recognition processes (default: all cores)")
+    parser.add_argument('--cooldown', type=float, default=30.0, help="seconds before the same entry repeats")
+    parser.add_argument('--db', default='face_recognition.db')
+    args = parser.parse_args()
+
+    engine = AccessEngine(args.sources, db_path=args.db, workers=args.workers, cooldown=args.cooldown).start()
+    try:
+        for event in engine.iter_events():
+            print(json.dumps(event), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.stop()
+        print(json.dumps(engine.stats(), indent=2))
@@ -0,0 +1,314 @@
+import os
+import sqlite3
+import numpy as np
+
+from gallery import FaceGallery, ENCODING_DIM, decode_encodings
+from gallery_snapshot import db_stamp
+
+# Rows compared against the centroids per block, so assigning a large gallery
+# never materialises the whole (N, nlist) distance matrix at once
+ASSIGN_BLOCK = 20000
+
+# Same keys as gallery_snapshot.db_stamp; saved with the index to tell which rows it holds
+STAMP_KEYS = ('count', 'max_id', 'template_max_id')
+
+
+def index_path_for(db_path):
+    """Index file lives next to the database, e.g. face_recognition.ivf.npz"""
+    base, _ = os.path.splitext(db_path)
+    return base + '.ivf.npz'
+
+
+def _sq_distances(probes, vectors):
+    sq = (np.einsum('ij,ij->i', probes, probes)[:, None]
+          + np.einsum('ij,ij->i', vectors, vectors)[None, :]
+          - 2.0 * (probes @ vectors.T))
+    return np.maximum(sq, 0.0, out=sq)
+
+
+def _nearest_cells(vectors, centroids, n=1):
+    """
+    The n closest centroids of every vector, closest first, computed block by block
+    :return: (len(vectors), n) cell numbers
+    """
+    n = min(n, len(centroids))
+    cells = np.empty((len(vectors), n), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BLOCK):
+        sq = _sq_distances(vectors[start:start + ASSIGN_BLOCK], centroids)
+        if n == 1:
+            cells[start:start + len(sq), 0] = np.argmin(sq, axis=1)
+            continue
+        if n < len(centroids):
+            top = np.argpartition(sq, n - 1, axis=1)[:, :n]
+        else:
+            top = np.broadcast_to(np.arange(len(centroids)), sq.shape)
+        order = np.argsort(np.take_along_axis(sq, top, axis=1), axis=1)
+        cells[start:start + len(sq)] = np.take_along_axis(top, order, axis=1)
+    return cells
+
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """Plain Lloyd's k-means, only used to train the coarse quantizer"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest_cells(vectors, centroids)[:, 0]
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty clusters so every list stays usable
+        if not filled.all():
+            centroids[~filled] = vectors[rng.choice(len(vectors), size=int((~filled).sum()), replace=False)]
+    return centroids
+
+
+class _InvertedList:
+    """Growable buffer of the user ids in one coarse cell"""
+
+    def __init__(self, capacity=16):
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def copy(self):
+        inv = _InvertedList(capacity=max(16, self.size))
+        inv.append(self.ids[:self.size])
+        return inv
+
+    def append(self, ids):
+        needed = self.size + len(ids)
+        if needed > len(self.ids):
+            self.ids = np.resize(self.ids, max(needed, 2 * len(self.ids)))
+        self.ids[self.size:needed] = ids
+        self.size = needed
+
+
+class IVFIndex:
+    """
+    IVF index: a k-means coarse quantizer splits the gallery into cells and a
+    probe only scans the `nprobe` closest cells. Cells hold user ids only; the
+    candidates are scored by the gallery searched alongside the index, so a
+    compact gallery scans its codes and re-ranks from its exact reference.
+    """
+
+    def __init__(self, centroids, nprobe=8):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float64)
+        self.nprobe = nprobe
+        self.lists = [_InvertedList() for _ in range(len(self.centroids))]
+        # db_stamp of the rows the index holds, as saved with it; None if unknown
+        self.stamp = None
+
+    @classmethod
+    def train(cls, encodings, nlist=None, nprobe=8, sample_size=100000, seed=0):
+        encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(len(encodings))))
+        nlist = min(nlist, len(encodings))
+
+        rng = np.random.default_rng(seed)
+        if len(encodings) > sample_size:
+            sample = encodings[rng.choice(len(encodings), size=sample_size, replace=False)]
+        else:
+            sample = encodings
+        return cls(kmeans(sample, nlist, seed=seed), nprobe=nprobe)
+
+    @classmethod
+    def build(cls, gallery, nlist=None, nprobe=8):
+        index = cls.train(gallery.encodings, nlist=nlist, nprobe=nprobe)
+        index.add(gallery.ids, gallery.encodings)
+        return index
+
+    def __len__(self):
+        return sum(inv.size for inv in self.lists)
+
+    def add(self, ids, encodings):
+        """Incremental insert; new rows go to their nearest existing cell"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        if not len(ids):
+            return
+        assign = _nearest_cells(encodings, self.centroids)[:, 0]
+        for cell in np.unique(assign):
+            rows = assign == cell
+            self.lists[cell].append(ids[rows])
+
+    def with_changes(self, add_ids=(), add_encodings=None, remove_ids=()):
+        """
+        Copy-on-write update: returns a new index that shares every untouched cell
+        with this one, so searches running against this index are unaffected
+        """
+        index = IVFIndex.__new__(IVFIndex)
+        index.centroids = self.centroids
+        index.nprobe = self.nprobe
+        index.lists = list(self.lists)
+        index.stamp = None
+
+        remove_ids = np.asarray(remove_ids, dtype=np.int64).reshape(-1)
+        if len(remove_ids):
+            for cell, inv in enumerate(index.lists):
+                drop = np.isin(inv.ids[:inv.size], remove_ids)
+                if drop.any():
+                    kept = _InvertedList(capacity=max(16, inv.size))
+                    kept.append(inv.ids[:inv.size][~drop])
+                    index.lists[cell] = kept
+
+        add_ids = np.asarray(add_ids, dtype=np.int64).reshape(-1)
+        if len(add_ids):
+            add_encodings = np.asarray(add_encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+            assign = _nearest_cells(add_encodings, index.centroids)[:, 0]
+            for cell in np.unique(assign):
+                rows = assign == cell
+                inv = index.lists[cell].copy()
+                inv.append(add_ids[rows])
+                index.lists[cell] = inv
+        return index
+
+    def search(self, probes, gallery, k=1, nprobe=None):
+        """
+        Approximate top-k for every probe
+        :param gallery: the gallery generation the index describes; scores the
+                        candidates, and is scanned exactly when the probed cells
+                        hold fewer than k of them
+        :return: list (one entry per probe) of [(user_id, distance), ...] closest first
+        """
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        cells = _nearest_cells(probes, self.centroids, n=nprobe or self.nprobe)
+
+        results = []
+        for probe, probe_cells in zip(probes, cells):
+            lists = [self.lists[c] for c in probe_cells if self.lists[c].size]
+            if not lists:
+                candidate_ids = np.empty(0, dtype=np.int64)
+            else:
+                candidate_ids = np.concatenate([inv.ids[:inv.size] for inv in lists])
+
+            if len(candidate_ids) < k:
+                results.append(gallery.search(probe, k=k)[0])
+            else:
+                results.append(gallery.search_among(probe, candidate_ids, k=k))
+        return results
+
+    def save(self, path, stamp=None):
+        """
+        Write the index under a temporary name and rename it into place
+        :param stamp: db_stamp of the rows the index holds, checked by load_index
+        """
+        ids = [inv.ids[:inv.size] for inv in self.lists]
+        offsets = np.cumsum([0] + [len(i) for i in ids])
+        # Several server processes may save at once; each writes its own file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                nprobe=np.int64(self.nprobe),
+                stamp=np.array([stamp[key] for key in STAMP_KEYS] if stamp else [], dtype=np.int64),
+                offsets=offsets,
+                ids=np.concatenate(ids) if ids else np.empty(0, dtype=np.int64),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(data['centroids'], nprobe=int(data['nprobe']))
+            offsets, ids = data['offsets'], data['ids']
+            for cell, inv in enumerate(index.lists):
+                inv.append(ids[offsets[cell]:offsets[cell + 1]])
+            # Indexes saved before stamps were recorded can't be validated
+            if 'stamp' in data.files and len(data['stamp']) == len(STAMP_KEYS):
+                index.stamp = dict(zip(STAMP_KEYS, data['stamp'].tolist()))
+        return index
+
+
+def load_index(index_path, db_path, stamp):
+    """
+    Saved index for the users table described by `stamp` (see gallery_snapshot.db_stamp).
+
+    An index saved for exactly those rows is used as-is. One that only lags
+    behind by newly registered users gets the missing rows added from the
+    database and is saved again. Anything else (deletions, moved centroids,
+    an unstamped or unreadable file) needs a rebuild.
+    :return: IVFIndex, or None when the caller has to rebuild
+    """
+    try:
+        index = IVFIndex.load(index_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    saved = index.stamp
+    if saved is None:
+        return None
+    stamp = {key: stamp[key] for key in STAMP_KEYS}
+    if saved == stamp:
+        return index
+    if saved['max_id'] > stamp['max_id'] or saved['template_max_id'] != stamp['template_max_id']:
+        return None
+
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT id, face_encoding FROM users WHERE id > ? AND id <= ? ORDER BY id",
+            (saved['max_id'], stamp['max_id'])).fetchall()
+    finally:
+        conn.close()
+    if saved['count'] + len(rows) != stamp['count']:
+        return None
+
+    index = index.with_changes(
+        add_ids=[user_id for user_id, _ in rows],
+        add_encodings=decode_encodings(blob for _, blob in rows))
+    index.save(index_path, stamp)
+    index.stamp = stamp
+    return index
+
+
+def recall_against_exact(index, gallery, probes, k=1, nprobe=None):
+    """Fraction of the exact top-k neighbours that the index also returns"""
+    exact = gallery.search(probes, k=k)
+    approx = index.search(probes, gallery, k=k, nprobe=nprobe)
+    hits = total = 0
+    for exact_row, approx_row in zip(exact, approx):
+        expected = {user_id for user_id, _ in exact_row}
+        hits += len(expected & {user_id for user_id, _ in approx_row})
+        total += len(expected)
+    return hits / total if total else 1.0
+
+
+def sample_probes(gallery, count=200, noise=0.03, seed=0):
+    """Perturbed gallery rows, close to how a second photo of the same person behaves"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), size=min(count, len(gallery)), replace=False)
+    return gallery.encodings[rows] + rng.normal(scale=noise, size=(len(rows), ENCODING_DIM))
+
+
+def build_index(db_path='face_recognition.db', nlist=None, nprobe=8):
+    conn = sqlite3.connect(db_path)
+    stamp = db_stamp(conn)
+    cursor = conn.cursor()
+    # Only the rows the stamp covers, so the saved stamp describes the index
+    cursor.execute("SELECT id, face_encoding FROM users WHERE id <= ?", (stamp['max_id'],))
+    rows = cursor.fetchall()
+    conn.close()
+
+    gallery = FaceGallery(
+        [row[0] for row in rows],
+        decode_encodings(row[1] for row in rows)
+    )
+    if not len(gallery):
+        print("No users registered, nothing to index")
+        return None
+
+    index = IVFIndex.build(gallery, nlist=nlist, nprobe=nprobe)
+    # Rows deleted meanwhile would make the stamp lie; unstamped, the app rebuilds
+    index.save(index_path_for(db_path), stamp if len(rows) == stamp['count'] else None)
+
+    probes = sample_probes(gallery)
+    print(f"Indexed {len(index)} encodings into {len(index.centroids)} cells")
+    for k in (1, 10):
+        print(f"Recall@{k} vs exact scan (nprobe={nprobe}): {recall_against_exact(index, gallery, probes, k=k):.3f}")
+    return index
+
+
+if __name__ == "__main__":
+    build_index()
@@ -1,73 +1,150 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-import cv2
-import face_recognition
-import sqlite3
 import numpy as np
-import base64
-from PIL import Image
-import io
 import os
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
+from gallery import FaceGallery, ENCODING_DIM, decode_encodings, encoding_blob
+from gallery_snapshot import load_gallery
+from compact_gallery import CompactGallery
+from partitions import GalleryPartitions
+from templates import TemplateStore, add_template
+from ann_index import STAMP_KEYS, IVFIndex, index_path_for, load_index, recall_against_exact, sample_probes
+from batching import MicroBatcher
+from recognition_pool import RecognitionPool, PoolBusy
+import db
+from loyalty import get_summary, record_points
+import metrics
+import migrations
+from rewards_catalog import RewardsCatalog
+from startup import WarmUp, lazy_import
+import config
+
+# cv2 and face_recognition (dlib models) are only imported when first used,
+# normally by the background warm-up below
+cv2 = lazy_import('cv2')
+face_pipeline = lazy_import('face_pipeline')
 
 app = Flask(__name__)
+metrics.enabled = config.METRICS_ENABLED
+warm_up = WarmUp('Face recognition')
 
-def init_loyalty_db():
-    try:
-        conn = sqlite3.connect('face_recognition.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS loyalty_cards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                business_name TEXT NOT NULL,
-                card_number TEXT UNIQUE,
-                points INTEGER DEFAULT 0,
-                tier_status TEXT DEFAULT 'Bronze',
-                registration_date TEXT,
-                last_used TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        print("Loyalty database initialized successfully")
-    except Exception as e:
-        print(f"Error initializing loyalty database: {str(e)}")
+# Create or upgrade the schema; cheap when the database is already current
+migrations.migrate()
 
-# Initialize database first
-init_loyalty_db()
+# Rewards catalog cache, reloaded whenever the catalog version moves
+rewards_catalog = RewardsCatalog()
 
-# Setup CORS after database initialization
+# Setup CORS
 CORS(app, resources={
     r"/api/*": {
         "origins": "*",  # For development only
-        "methods": ["GET", "POST", "OPTIONS"],
+        "methods": ["GET", "POST", "DELETE", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
         "max_age": 3600
     }
 })
 
 class DatabaseFaceRecognition:
-    def __init__(self, db_path='face_recognition.db'):
-        self.known_face_encodings = []
-        self.known_face_metadata = []
+    """
+    In-memory face gallery backed by the users table.
+
+    The searchable state (gallery matrix + optional ANN index) is one immutable
+    generation tuple. Writers build the next generation under a lock and publish
+    it with a single attribute assignment, so readers never block and always see
+    a consistent matrix.
+
+    Encodings come from a memory-mapped snapshot (see gallery_snapshot.py); user
+    details are only read from the database for the rows that actually match.
+    Searches can be scoped to one business's card holders (see partitions.py).
+
+    The gallery holds one centroid per user. Users with several face templates
+    are re-scored against their templates after the centroid shortlist (see
+    templates.py), so extra photos do not grow the first-pass search.
+    """
+
+    def __init__(self, db_path='face_recognition.db', use_ann=None, encoder_pool=None):
+        self.db_path = db_path
+        self.encoder_pool = encoder_pool
+        self.use_ann = config.ANN_ENABLED if use_ann is None else use_ann
+        self._generation = (FaceGallery.empty(), None)
+        self.partitions = GalleryPartitions()
+        self.templates = TemplateStore(db_path, cache_size=config.TEMPLATE_CACHE_SIZE)
+        self._write_lock = threading.Lock()
+        self._max_user_id = 0
+        # db_stamp of the rows the ANN index holds, None once that is unknown
+        self._ann_stamp = None
+        self._ann_save_timer = None
+        self._data_version = None
+        self._last_refresh_check = 0.0
+        # Dedicated connection for PRAGMA data_version: it only changes when
+        # *another* connection commits, which makes it a cheap change detector
+        self._watch_conn = db.connect(db_path, check_same_thread=False)
+        self.pool = db.get_pool(db_path)
         self.load_database(db_path)
 
+    @property
+    def gallery(self):
+        return self._generation[0]
+
+    @property
+    def ann_index(self):
+        return self._generation[1]
+
     def load_database(self, db_path):
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, name, age, email, phone, registered_date, image_path, face_encoding 
-            FROM users
-        """)
-        users = cursor.fetchall()
-        
-        for user in users:
-            user_id, name, age, email, phone, reg_date, img_path, db_encoding = user
-            face_encoding = np.frombuffer(db_encoding, dtype=np.float64)
-            self.known_face_encodings.append(face_encoding)
-            self.known_face_metadata.append({
+        with self._write_lock:
+            # Read the version first so rows committed during the load are picked up later
+            data_version = self._read_data_version()
+            gallery, stamp = load_gallery(db_path)
+            if config.GALLERY_PRECISION != 'float64':
+                # The float64 snapshot stays mapped as the exact re-rank reference
+                gallery = CompactGallery.from_gallery(
+                    gallery, config.GALLERY_PRECISION, rerank=config.GALLERY_RERANK)
+
+            ann_index = None
+            if self.use_ann and len(gallery) >= config.ANN_MIN_GALLERY_SIZE:
+                ann_index = self.load_ann_index(db_path, gallery, stamp)
+
+            with self.pool.connection() as conn:
+                partitions = GalleryPartitions.load(conn)
+                self.templates.load(conn)
+
+            self._generation = (gallery, ann_index)
+            self.partitions = partitions
+            self._max_user_id = stamp['max_id']
+            self._ann_stamp = {key: stamp[key] for key in STAMP_KEYS} if ann_index is not None else None
+            self._data_version = data_version
+
+    def load_ann_index(self, db_path, gallery, stamp):
+        """Saved index when it holds exactly the gallery's rows (or can catch up), else a rebuild"""
+        index_path = index_path_for(db_path)
+        if os.path.exists(index_path):
+            index = load_index(index_path, db_path, stamp)
+            if index is not None:
+                return index
+            print("ANN index is out of date, rebuilding")
+
+        index = IVFIndex.build(gallery, nprobe=config.ANN_NPROBE)
+        index.save(index_path, stamp)
+        recall = recall_against_exact(index, gallery, sample_probes(gallery), k=1)
+        print(f"ANN index built: {len(index)} encodings, {len(index.centroids)} cells, recall@1 {recall:.3f}")
+        return index
+
+    @metrics.timed('user_lookup')
+    def lookup_users(self, user_ids):
+        """User details by primary key, for the handful of ids a search returned"""
+        user_ids = sorted(set(user_ids))
+        if not user_ids:
+            return {}
+        with self.pool.connection() as conn:
+            users = conn.execute(f"""
+                SELECT id, name, age, email, phone, registered_date, image_path
+                FROM users WHERE id IN ({','.join('?' * len(user_ids))})
+            """, user_ids).fetchall()
+
+        return {
+            user_id: {
                 'id': user_id,
                 'name': name,
                 'age': age,
@@ -75,113 +152,592 @@ class DatabaseFaceRecognition:
                 'phone': phone,
                 'registered_date': reg_date,
                 'image_path': img_path
-            })
-        conn.close()
+            }
+            for user_id, name, age, email, phone, reg_date, img_path in users
+        }
 
-    def identify_face(self, image_data, tolerance=0.6):
-        try:
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-            frame = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            
-            face_locations = face_recognition.face_locations(frame)
-            if not face_locations:
-                return None
-            
-            face_encodings = face_recognition.face_encodings(frame, face_locations)
-            
-            for face_encoding in face_encodings:
-                matches = face_recognition.compare_faces(
-                    self.known_face_encodings, 
-                    face_encoding,
-                    tolerance=tolerance
-                )
-                
-                if True in matches:
-                    first_match_index = matches.index(True)
-                    return self.known_face_metadata[first_match_index]
-            
-            return None
-        except Exception as e:
-            print(f"Error processing image: {str(e)}")
-            return None
+    def add_users(self, user_ids, face_encodings):
+        """Publish newly registered users without reloading the database"""
+        user_ids = np.asarray(user_ids, dtype=np.int64).reshape(-1)
+        face_encodings = np.asarray(face_encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+
+        with self._write_lock:
+            gallery, ann_index = self._generation
+            # Registration and the change detector can race to add the same row
+            fresh = ~gallery.contains(user_ids)
+            user_ids, face_encodings = user_ids[fresh], face_encodings[fresh]
+            if not len(user_ids):
+                return
+
+            if ann_index is not None:
+                ann_index = ann_index.with_changes(add_ids=user_ids, add_encodings=face_encodings)
+                self._ann_changed(count=len(user_ids), max_id=int(user_ids.max()))
+            self._generation = (gallery.with_added(user_ids, face_encodings), ann_index)
+            self._max_user_id = max(self._max_user_id, int(user_ids.max()))
+
+    def add_user(self, user_id, face_encoding):
+        self.add_users([user_id], [face_encoding])
+
+    def remove_users(self, user_ids):
+        user_ids = np.asarray(list(user_ids), dtype=np.int64)
+        if not len(user_ids):
+            return
+        with self._write_lock:
+            gallery, ann_index = self._generation
+            if ann_index is not None:
+                ann_index = ann_index.with_changes(remove_ids=user_ids)
+                self._ann_changed(count=-int(gallery.contains(np.unique(user_ids)).sum()))
+            self._generation = (gallery.with_removed(user_ids), ann_index)
+            self.partitions.remove_users(user_ids)
+            self.templates.forget(user_ids)
+
+    def update_users(self, user_ids, face_encodings, template_max_id=None):
+        """
+        Publish moved centroids (after a template was added) for users already in the gallery
+        :param template_max_id: newest face_templates id these centroids account for, if known
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64).reshape(-1)
+        face_encodings = np.asarray(face_encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        if not len(user_ids):
+            return
+        with self._write_lock:
+            gallery, ann_index = self._generation
+            if ann_index is not None:
+                ann_index = ann_index.with_changes(
+                    add_ids=user_ids, add_encodings=face_encodings, remove_ids=user_ids)
+                self._ann_changed(template_max_id=template_max_id, forget=template_max_id is None)
+            self._generation = (gallery.with_removed(user_ids).with_added(user_ids, face_encodings), ann_index)
+            self.partitions.update_users(dict(zip(user_ids.tolist(), face_encodings)))
+
+    def add_template(self, user_id, face_encoding, image_path=None):
+        """
+        Store another face template for a user and search with the new centroid
+        :return: number of templates the user now has, 0 if the user does not exist
+        """
+        template_max_id = None
+        with self.pool.connection() as conn:
+            centroid, count = add_template(conn, user_id, face_encoding, image_path, config.ENCODING_STORAGE)
+            if centroid is not None:
+                with self._write_lock:
+                    # Templates other processes added move centroids this update doesn't carry
+                    if set(self.templates.changed(conn)) <= {int(user_id)}:
+                        template_max_id = self.templates.max_template_id
+        if centroid is not None:
+            self.update_users([user_id], [centroid], template_max_id)
+        return count
+
+    def _ann_changed(self, count=0, max_id=0, template_max_id=None, forget=False):
+        """Move the ANN index's stamp along with a change (under _write_lock) and schedule a save"""
+        stamp = self._ann_stamp
+        if stamp is None or forget:
+            self._ann_stamp = None
+            return
+        self._ann_stamp = {
+            'count': stamp['count'] + count,
+            'max_id': max(stamp['max_id'], max_id),
+            'template_max_id': stamp['template_max_id'] if template_max_id is None else template_max_id
+        }
+        if self._ann_save_timer is None:
+            self._ann_save_timer = threading.Timer(config.ANN_SAVE_DELAY, self.save_ann_index)
+            self._ann_save_timer.daemon = True
+            self._ann_save_timer.start()
+
+    def save_ann_index(self):
+        """
+        Persist the live ANN index with the stamp of the rows it holds, so a
+        restart loads it instead of rebuilding. Changes are batched: the first
+        change after a save schedules the next one ANN_SAVE_DELAY seconds later.
+        :return: True if the index was written
+        """
+        with self._write_lock:
+            self._ann_save_timer = None
+            ann_index, stamp = self._generation[1], self._ann_stamp
+        if ann_index is None or stamp is None:
+            return False
+        # Generations are never modified, so writing outside the lock is safe
+        ann_index.save(index_path_for(self.db_path), stamp)
+        return True
+
+    def _card_encodings(self, cursor, cards):
+        user_ids = sorted({user_id for _, user_id, _ in cards})
+        cursor.execute(
+            f"SELECT id, face_encoding FROM users WHERE id IN ({','.join('?' * len(user_ids))})", user_ids)
+        rows = cursor.fetchall()
+        return dict(zip((user_id for user_id, _ in rows), decode_encodings(blob for _, blob in rows)))
+
+    def add_cards(self, cards):
+        """
+        Put card holders into their business's partition
+        :param cards: [(card_id, user_id, business_name)]
+        """
+        if not cards:
+            return
+        with self._write_lock:
+            encodings = self._card_encodings(self._watch_conn.cursor(), cards)
+            self.partitions.add_members(cards, encodings)
+
+    def _read_data_version(self):
+        return self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    @metrics.timed('refresh')
+    def refresh_if_changed(self, min_interval=None):
+        """
+        Pick up rows written by other connections or processes (e.g. register_user.py).
+        Costs one PRAGMA per interval when nothing has changed.
+        """
+        min_interval = config.GALLERY_REFRESH_INTERVAL if min_interval is None else min_interval
+        now = time.monotonic()
+        if now - self._last_refresh_check < min_interval:
+            return False
+        self._last_refresh_check = now
 
-# Initialize face recognition system
-face_recognizer = DatabaseFaceRecognition()
+        with self._write_lock:
+            data_version = self._read_data_version()
+            if data_version == self._data_version:
+                return False
+            self._data_version = data_version
+
+            cursor = self._watch_conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM users")
+            count = cursor.fetchone()[0]
+            cursor.execute("SELECT id, face_encoding FROM users WHERE id > ?", (self._max_user_id,))
+            new_rows = cursor.fetchall()
+
+            removed_ids = []
+            if count != len(self.gallery) + len(new_rows):
+                cursor.execute("SELECT id FROM users WHERE id <= ?", (self._max_user_id,))
+                remaining = np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+                removed_ids = np.setdiff1d(self.gallery.ids, remaining)
+
+            cursor.execute(
+                "SELECT id, user_id, business_name FROM loyalty_cards WHERE id > ? AND user_id IS NOT NULL",
+                (self.partitions.max_card_id,))
+            new_cards = cursor.fetchall()
+
+            # Templates added elsewhere moved those users' centroids
+            moved_rows = []
+            moved_ids = [user_id for user_id in self.templates.changed(self._watch_conn)
+                         if user_id <= self._max_user_id]
+            template_max_id = self.templates.max_template_id
+            if moved_ids:
+                cursor.execute(
+                    f"SELECT id, face_encoding FROM users WHERE id IN ({','.join('?' * len(moved_ids))})",
+                    moved_ids)
+                moved_rows = cursor.fetchall()
+
+        self.add_cards(new_cards)
+        if moved_rows:
+            self.update_users(
+                [user_id for user_id, _ in moved_rows],
+                decode_encodings(blob for _, blob in moved_rows),
+                template_max_id
+            )
+        if new_rows:
+            self.add_users(
+                [user_id for user_id, _ in new_rows],
+                decode_encodings(blob for _, blob in new_rows)
+            )
+        if len(removed_ids):
+            self.remove_users(removed_ids)
+        return bool(new_rows or len(removed_ids) or new_cards or moved_rows)
+
+    @metrics.timed('search')
+    def nearest(self, face_encodings, k=1, business=None):
+        """
+        Top-k (user_id, distance) per probe, through the ANN index when one is loaded.
+        With a business, only that business's card holders are searched (exactly;
+        a partition is small).
+        """
+        gallery, ann_index = self._generation
+        if business is not None:
+            partition = self.partitions.gallery(business, gallery)
+            if partition is None:
+                return [[] for _ in range(len(face_encodings))]
+            return partition.search(face_encodings, k=k)
+        if ann_index is not None:
+            return ann_index.search(face_encodings, gallery, k=k)
+        return gallery.search(face_encodings, k=k)
+
+    def match_encodings(self, face_encodings, tolerance=0.6, k=1, business=None):
+        """
+        Top-k nearest registered users for each probe encoding, filtered by tolerance
+        :param business: restrict to one business's partition; a list gives one per probe
+        :return: list (one entry per probe) of [(metadata, distance), ...] closest first
+        """
+        # First pass over centroids; shortlist wider when some users have several templates
+        shortlist = max(k, config.TEMPLATE_SHORTLIST) if len(self.templates) else k
+        if isinstance(business, (list, tuple)):
+            # Mixed batch: one search per partition, results put back in probe order
+            rows = [None] * len(face_encodings)
+            for scope in set(business):
+                positions = [i for i, b in enumerate(business) if b == scope]
+                found = self.nearest([face_encodings[i] for i in positions], k=shortlist, business=scope)
+                for i, row in zip(positions, found):
+                    rows[i] = row
+        else:
+            rows = self.nearest(face_encodings, k=shortlist, business=business)
+        if len(self.templates):
+            with metrics.stage('template_rescore'):
+                rows = self.templates.rescore(face_encodings, rows, k=k)
+        else:
+            rows = [row[:k] for row in rows]
+
+        neighbours = [
+            [(user_id, distance) for user_id, distance in row if distance <= tolerance]
+            for row in rows
+        ]
+        # Users deleted since the search started simply drop out here
+        users = self.lookup_users(user_id for row in neighbours for user_id, _ in row)
+        return [
+            [(users[user_id], distance) for user_id, distance in row if user_id in users]
+            for row in neighbours
+        ]
+
+    def analyze_images(self, images):
+        """
+        Decode, detect and encode each image, in the recognition workers when
+        there is a pool, else in the calling thread
+        :return: list of (encodings, reason code or None) per image
+        """
+        if self.encoder_pool is not None:
+            # Detection and encoding run in the workers; only the round trip is visible here
+            with metrics.stage('pool_analyze'):
+                return self.encoder_pool.analyze_images(images)
+        per_image = []
+        for image_bytes in images:
+            try:
+                per_image.append(face_pipeline.analyze_image(image_bytes))
+            except Exception as e:
+                print(f"Error processing image: {str(e)}")
+                per_image.append(([], 'error'))
+        return per_image
+
+    def match_images(self, per_image, tolerance=0.6, business=None):
+        """
+        Match already encoded images: every probe from every image is searched
+        against the gallery at once
+        :param per_image: (encodings, reason code or None) per image, as from analyze_images
+        :param business: restrict every image to one business's members, or a
+                         list with one business (or None) per image
+        :return: list of (best match metadata dict with distance, None) or
+                 (None, reason code) per image
+        """
+        self.refresh_if_changed()
+
+        probes = [encoding for encodings, _ in per_image for encoding in encodings]
+        if isinstance(business, (list, tuple)):
+            business = [scope for (encodings, _), scope in zip(per_image, business) for _ in encodings]
+        matches = self.match_encodings(probes, tolerance=tolerance, business=business) if probes else []
+
+        results = []
+        start = 0
+        for encodings, reason in per_image:
+            # Closest registered user over every face in the frame, not the first hit
+            found = [m[0] for m in matches[start:start + len(encodings)] if m]
+            start += len(encodings)
+            if not found:
+                results.append((None, reason or 'not_recognized'))
+                metrics.identify_results.inc(reason or 'not_recognized')
+                continue
+            metadata, distance = min(found, key=lambda m: m[1])
+            results.append((dict(metadata, distance=distance), None))
+            metrics.identify_results.inc('matched')
+        return results
+
+    def identify_batch(self, images, tolerance=0.6, business=None):
+        """
+        Identify several images at once: analyze_images followed by match_images
+        :return: list of (best match metadata dict with distance, None) or
+                 (None, reason code) per image
+        """
+        return self.match_images(self.analyze_images(images), tolerance=tolerance, business=business)
+
+# Recognition state, published by the warm-up steps; None until then
+face_recognizer = None
+identify_batcher = None
+identify_sessions = None
+
+# Optional pool of recognition worker processes. The workers are forked here,
+# before any other thread exists, and load their models in parallel while the
+# warm-up thread waits for them
+recognition_pool = None
+pool_started = []
+if config.RECOGNITION_WORKERS > 0:
+    recognition_pool = RecognitionPool(
+        config.RECOGNITION_WORKERS,
+        queue_depth=config.RECOGNITION_QUEUE_DEPTH,
+        timeout=config.RECOGNITION_TIMEOUT
+    )
+    pool_started = recognition_pool.start()
+
+def load_recognizer():
+    global face_recognizer
+    face_recognizer = DatabaseFaceRecognition(encoder_pool=recognition_pool)
+
+def load_models():
+    if recognition_pool is not None:
+        print(f"Recognition workers ready: {recognition_pool.warm_up(pool_started)}")
+        return
+    # Imports cv2 / face_recognition and runs each dlib stage once
+    face_pipeline.encode_frame(np.zeros((64, 64, 3), dtype=np.uint8))
+
+def start_identify_services():
+    global identify_batcher, identify_sessions
+    from identify_sessions import IdentifySessionStore
+
+    # Coalesce the gallery searches of concurrent /api/identify calls; each
+    # request still decodes and encodes its image in its own thread (or the pool)
+    if config.IDENTIFY_BATCH_ENABLED:
+        identify_batcher = MicroBatcher(
+            identify_requests,
+            window_ms=config.IDENTIFY_BATCH_WINDOW_MS,
+            max_batch=config.IDENTIFY_MAX_BATCH,
+            name='identify-batcher'
+        )
+
+    # Streaming login sessions with temporal voting (see identify_sessions.py)
+    identify_sessions = IdentifySessionStore(
+        face_recognizer,
+        required_votes=config.SESSION_REQUIRED_VOTES,
+        ttl=config.SESSION_TTL,
+        pool=recognition_pool
+    )
+
+def identify_requests(requests):
+    """Batch handler: requests are ((encodings, reason), business or None) pairs"""
+    return face_recognizer.match_images(
+        [analyzed for analyzed, _ in requests],
+        business=[business for _, business in requests]
+    )
+
+# Loyalty endpoints serve straight away; recognition endpoints answer 503 until this is done
+warm_up.step('gallery', load_recognizer).step('models', load_models).step('services', start_identify_services)
+warm_up.start(background=config.WARMUP_BACKGROUND)
+
+metrics.gauge('facetag_recognition_ready', 'Whether face recognition finished warming up',
+              lambda: int(warm_up.ready))
+metrics.gauge('facetag_time_to_ready_seconds', 'Seconds from start-up until face recognition was ready',
+              lambda: warm_up.time_to_ready if warm_up.ready else 0)
+metrics.gauge('facetag_gallery_users', 'Users in the searchable gallery',
+              lambda: len(face_recognizer.gallery) if face_recognizer is not None else 0)
+metrics.gauge('facetag_multi_template_users', 'Users with more than one face template',
+              lambda: len(face_recognizer.templates) if face_recognizer is not None else 0)
+metrics.gauge('facetag_identify_sessions', 'Open streaming identify sessions',
+              lambda: len(identify_sessions) if identify_sessions is not None else 0)
+
+def recognition_not_ready():
+    """503 response while the warm-up is still running (or failed), None once ready"""
+    if warm_up.ready:
+        return None
+    response = jsonify({
+        'error': 'Face recognition is not ready yet',
+        'status': warm_up.state
+    })
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def get_db():
+    """
+    Pooled connection for the current request (see db.py). It goes back to the
+    pool when the request ends, whichever way the route returned, with any
+    uncommitted work rolled back.
+    """
+    if 'db' not in g:
+        g.db = db.get_pool().acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db.get_pool().release(conn)
+
+@app.before_request
+def start_request_timer():
+    if metrics.enabled:
+        metrics.begin_request()
+
+@app.after_request
+def record_request_metrics(response):
+    if not metrics.enabled:
+        return response
+    total, timings = metrics.end_request()
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.request_seconds.observe(total, request.method, route, response.status_code)
+    if response.status_code >= 500:
+        metrics.errors.inc(route)
+    if config.METRICS_TIMING_HEADER:
+        response.headers['Server-Timing'] = metrics.server_timing(total, timings)
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/health/live', methods=['GET'])
+def health_live():
+    # The process is up and serving; says nothing about recognition
+    return jsonify({'status': 'ok'})
+
+@app.route('/api/health/ready', methods=['GET'])
+def health_ready():
+    return jsonify(warm_up.status()), 200 if warm_up.ready else 503
+
+@metrics.timed('read_request')
+def read_request_image():
+    """
+    Image bytes plus the other fields of an upload, in any supported format:
+    a raw image/* body (fields in the query string), a multipart form with an
+    'image' file, or the legacy JSON body with a base64 data URL
+    :return: (image bytes or None, fields dict)
+    """
+    if request.mimetype.startswith('image/'):
+        return request.get_data(), request.args.to_dict()
+
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('image')
+        return (upload.read() if upload else None), request.form.to_dict()
+
+    data = request.get_json(silent=True) or {}
+    fields = {k: v for k, v in data.items() if k != 'image'}
+    image_data = data.get('image')
+    return (face_pipeline.decode_base64_image(image_data) if image_data else None), fields
+
+def save_uploaded_image(image_bytes, image_path, face_frame=None):
+    # Uploads are normally JPEG already; store them as sent instead of re-encoding
+    if image_bytes[:2] == b'\xff\xd8':
+        with open(image_path, 'wb') as f:
+            f.write(image_bytes)
+    else:
+        if face_frame is None:
+            face_frame = face_pipeline.decode_image_bytes(image_bytes)
+        cv2.imwrite(image_path, cv2.cvtColor(face_frame, cv2.COLOR_RGB2BGR))
 
 @app.route('/api/identify', methods=['POST'])
 def identify_face():
+    not_ready = recognition_not_ready()
+    if not_ready:
+        return not_ready
     try:
-        image_data = request.json.get('image')
-        if not image_data:
+        image_bytes, fields = read_request_image()
+        if not image_bytes:
             return jsonify({'error': 'No image data provided'}), 400
 
-        user_info = face_recognizer.identify_face(image_data)
+        # Optional scope: only match members holding a card for this business
+        business = fields.get('business') or request.args.get('business')
+        if identify_batcher is not None:
+            analyzed = face_recognizer.analyze_images([image_bytes])[0]
+            # Includes queueing for the batch window; the search itself is timed stage by stage
+            with metrics.stage('identify_batched'):
+                user_info, reason = identify_batcher.call((analyzed, business), timeout=config.IDENTIFY_TIMEOUT)
+        else:
+            user_info, reason = face_recognizer.identify_batch([image_bytes], business=business)[0]
         
+        # Matches already carry the user's primary key, no second lookup needed
         if user_info:
-            # Get user ID from database
-            conn = sqlite3.connect('face_recognition.db')
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT id FROM users 
-                WHERE name = ? AND email = ?
-            """, (user_info['name'], user_info['email']))
-            result = cursor.fetchone()
-            conn.close()
-            
-            if result:
-                user_info['id'] = result[0]  # Add user ID to response
-                return jsonify({
-                    'success': True,
-                    'user': user_info
-                })
+            return jsonify({
+                'success': True,
+                'user': user_info
+            })
         return jsonify({
             'success': False,
-            'message': 'No face found or face not recognized'
+            'message': 'No face found or face not recognized',
+            'reason': reason
         })
 
+    except PoolBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except TimeoutError:
+        return jsonify({'error': 'Recognition timed out'}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/identify/session', methods=['POST'])
+def open_identify_session():
+    not_ready = recognition_not_ready()
+    if not_ready:
+        return not_ready
+    data = request.get_json(silent=True) or {}
+    session = identify_sessions.open(business=data.get('business') or request.args.get('business'))
+    return jsonify({
+        'success': True,
+        'session_id': session.id,
+        'required_votes': identify_sessions.required_votes
+    })
+
+@app.route('/api/identify/session/<session_id>/frame', methods=['POST'])
+def identify_session_frame(session_id):
+    not_ready = recognition_not_ready()
+    if not_ready:
+        return not_ready
+    try:
+        session = identify_sessions.get(session_id)
+        if session is None:
+            return jsonify({'error': 'Session not found or expired'}), 404
+
+        image_bytes, _ = read_request_image()
+        if not image_bytes:
+            return jsonify({'error': 'No image data provided'}), 400
+
+        face_recognizer.refresh_if_changed()
+        frame = face_pipeline.decode_image_bytes(image_bytes)
+        state = identify_sessions.process_frame(session, frame)
+        return jsonify(dict(state, success=state['accepted']))
+
+    except PoolBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except TimeoutError:
+        return jsonify({'error': 'Recognition timed out'}), 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/identify/session/<session_id>', methods=['DELETE'])
+def close_identify_session(session_id):
+    not_ready = recognition_not_ready()
+    if not_ready:
+        return not_ready
+    if not identify_sessions.close(session_id):
+        return jsonify({'error': 'Session not found or expired'}), 404
+    return jsonify({'success': True})
+
 @app.route('/api/register', methods=['POST'])
 def register_user():
+    not_ready = recognition_not_ready()
+    if not_ready:
+        return not_ready
     try:
         print("Received registration request")
         
-        data = request.json
-        if not data:
+        image_bytes, data = read_request_image()
+        if not image_bytes and not data:
             print("No data provided in request")
             return jsonify({'error': 'No data provided'}), 400
 
-        print("Received data:", {k: v for k, v in data.items() if k != 'image'})
+        print("Received data:", data)
 
-        required_fields = ['name', 'age', 'image']
-        if not all(field in data for field in required_fields):
-            missing_fields = [field for field in required_fields if field not in data]
+        required_fields = ['name', 'age']
+        missing_fields = [field for field in required_fields if field not in data]
+        if not image_bytes:
+            missing_fields.append('image')
+        if missing_fields:
             print(f"Missing required fields: {missing_fields}")
             return jsonify({'error': f'Missing required fields: {missing_fields}'}), 400
 
-        image_data = data['image']
-        if ',' in image_data:
-            image_data = image_data.split(',')[1]
-        
         try:
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
-            
             os.makedirs('images', exist_ok=True)
             
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             image_path = f'images/user_{timestamp}.jpg'
-            image.save(image_path)
+            if recognition_pool is not None:
+                face_encodings = recognition_pool.encode_image(image_bytes)
+                face_frame = None
+            else:
+                face_frame = face_pipeline.decode_image_bytes(image_bytes)
+                face_encodings = face_pipeline.encode_frame(face_frame)
+
+            save_uploaded_image(image_bytes, image_path, face_frame)
             print(f"Image saved to {image_path}")
             
-            face_frame = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            face_encodings = face_recognition.face_encodings(face_frame)
-            
             if not face_encodings:
                 print("No face detected in the image")
                 os.remove(image_path)
@@ -192,7 +748,7 @@ def register_user():
             
             face_encoding = face_encodings[0]
             
-            conn = sqlite3.connect('face_recognition.db')
+            conn = get_db()
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -205,13 +761,15 @@ def register_user():
                 data.get('phone'),
                 datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                 image_path,
-                face_encoding.tobytes()
+                encoding_blob(face_encoding, config.ENCODING_STORAGE)
             ))
             
             user_id = cursor.lastrowid
             conn.commit()
-            conn.close()
             print("User successfully registered in database")
+
+            # Make the new user recognizable straight away
+            face_recognizer.add_user(user_id, face_encoding)
             
             return jsonify({
                 'success': True,
@@ -233,6 +791,97 @@ def register_user():
             'message': str(e)
         }), 500
 
+@app.route('/api/users/<int:user_id>/templates', methods=['POST'])
+def add_user_template(user_id):
+    """Another photo of an existing user (different lighting, glasses, ...)"""
+    not_ready = recognition_not_ready()
+    if not_ready:
+        return not_ready
+    try:
+        image_bytes, _ = read_request_image()
+        if not image_bytes:
+            return jsonify({'error': 'No image data provided'}), 400
+
+        if recognition_pool is not None:
+            face_encodings = recognition_pool.encode_image(image_bytes)
+        else:
+            face_encodings = face_pipeline.encode_image(image_bytes)
+        if not face_encodings:
+            return jsonify({
+                'success': False,
+                'message': 'No face detected in the image'
+            }), 400
+
+        os.makedirs('images', exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        image_path = f'images/user_{user_id}_template_{timestamp}.jpg'
+        save_uploaded_image(image_bytes, image_path)
+
+        count = face_recognizer.add_template(user_id, face_encodings[0], image_path)
+        if not count:
+            os.remove(image_path)
+            return jsonify({
+                'success': False,
+                'error': 'User not found'
+            }), 404
+
+        return jsonify({
+            'success': True,
+            'message': 'Face template added successfully',
+            'user_id': user_id,
+            'templates': count
+        })
+
+    except PoolBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except TimeoutError:
+        return jsonify({'error': 'Recognition timed out'}), 504
+    except Exception as e:
+        print(f"Error in add_user_template: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/users/<int:user_id>', methods=['DELETE'])
+def delete_user(user_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT image_path FROM users WHERE id = ?', (user_id,))
+        user = cursor.fetchone()
+        if not user:
+            return jsonify({
+                'success': False,
+                'error': 'User not found'
+            }), 404
+
+        # Delete dependent rows first, same order as clear.py
+        cursor.execute('DELETE FROM points_history WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM user_rewards WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM loyalty_cards WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM face_templates WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM user_summary WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        conn.commit()
+
+        # A gallery still loading picks the deletion up on its first refresh
+        if face_recognizer is not None:
+            face_recognizer.remove_users([user_id])
+
+        return jsonify({
+            'success': True,
+            'message': 'User deleted successfully'
+        })
+
+    except Exception as e:
+        print(f"Error in delete_user: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/api/loyalty/add', methods=['POST'])
 def add_loyalty_card():
     try:
@@ -242,14 +891,13 @@ def add_loyalty_card():
         if not all(field in data for field in required_fields):
             return jsonify({'error': 'Missing required fields'}), 400
 
-        conn = sqlite3.connect('face_recognition.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         # Check if user exists
         cursor.execute('SELECT id FROM users WHERE id = ?', (data['user_id'],))
         user = cursor.fetchone()
         if not user:
-            conn.close()
             return jsonify({
                 'success': False,
                 'error': 'User not found'
@@ -260,7 +908,6 @@ def add_loyalty_card():
         existing_card = cursor.fetchone()
         
         if existing_card:
-            conn.close()
             return jsonify({
                 'success': False,
                 'error': 'This card number is already registered'
@@ -273,6 +920,9 @@ def add_loyalty_card():
             'StyleFusion': 150,
             'FitLife': 75
         }
+        bonus = initial_points.get(data['business_name'], 0)
+        # New cards carry the holder's current tier
+        _, tier = get_summary(conn, data['user_id'])
 
         cursor.execute('''
             INSERT INTO loyalty_cards 
@@ -282,20 +932,28 @@ def add_loyalty_card():
             data['user_id'],
             data['business_name'],
             data['card_number'],
-            initial_points.get(data['business_name'], 0),
-            'Bronze',
+            bonus,
+            tier,
             datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         ))
-        
-        conn.commit()
         card_id = cursor.lastrowid
+
+        # The sign-up bonus goes through the ledger and the user's points summary,
+        # in the same transaction as the card; a tier change updates every card
+        if bonus:
+            record_points(conn, data['user_id'], bonus, 'earn',
+                          f"Sign-up bonus for card {data['card_number']}", data['business_name'])
+        conn.commit()
+
+        # The new card holder becomes searchable from the business's kiosks right away
+        if face_recognizer is not None:
+            face_recognizer.add_cards([(card_id, int(data['user_id']), data['business_name'])])
         
         cursor.execute('''
             SELECT * FROM loyalty_cards WHERE id = ?
         ''', (card_id,))
         
         new_card = cursor.fetchone()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -324,14 +982,13 @@ def get_loyalty_cards():
         if not user_id:
             return jsonify({'error': 'User ID required'}), 400
 
-        conn = sqlite3.connect('face_recognition.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         # Check if user exists
         cursor.execute('SELECT id FROM users WHERE id = ?', (user_id,))
         user = cursor.fetchone()
         if not user:
-            conn.close()
             return jsonify({
                 'success': False,
                 'error': 'User not found'
@@ -344,7 +1001,6 @@ def get_loyalty_cards():
         ''', (user_id,))
         
         cards = cursor.fetchall()
-        conn.close()
         
         card_list = []
         for card in cards:
@@ -366,61 +1022,6 @@ def get_loyalty_cards():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
-def init_rewards_db():
-    try:
-        conn = sqlite3.connect('face_recognition.db')
-        cursor = conn.cursor()
-        
-        # Create rewards table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS rewards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                type TEXT NOT NULL,          -- 'birthday', 'milestone', 'tier', 'points'
-                business_name TEXT,          -- NULL for general rewards
-                name TEXT NOT NULL,
-                description TEXT,
-                points_required INTEGER,
-                tier_required TEXT,          -- 'Bronze', 'Silver', 'Gold'
-                active BOOLEAN DEFAULT 1
-            )
-        ''')
-        
-        # Create user rewards table (for tracking claimed rewards)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_rewards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                reward_id INTEGER,
-                claim_date TEXT,
-                expiry_date TEXT,
-                status TEXT,               -- 'claimed', 'used', 'expired'
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (reward_id) REFERENCES rewards (id)
-            )
-        ''')
-        
-        # Create points history table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS points_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                business_name TEXT,
-                points_change INTEGER,      -- Can be positive or negative
-                transaction_type TEXT,      -- 'earn', 'redeem', 'expire'
-                description TEXT,
-                transaction_date TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        conn.commit()
-        print("Rewards database initialized successfully")
-        
-    except Exception as e:
-        print(f"Error initializing rewards database: {str(e)}")
-    finally:
-        conn.close()
-
 @app.route('/api/loyalty/rewards', methods=['GET'])
 @app.route('/api/loyalty/rewards', methods=['GET'])
 def get_rewards():
@@ -429,69 +1030,16 @@ def get_rewards():
         if not user_id:
             return jsonify({'error': 'User ID required'}), 400
 
-        conn = sqlite3.connect('face_recognition.db')
-        cursor = conn.cursor()
+        conn = get_db()
 
-        # Get user's total points and determine tier
-        cursor.execute('SELECT SUM(points) FROM loyalty_cards WHERE user_id = ?', (user_id,))
-        total_points = cursor.fetchone()[0] or 0
-        tier = calculate_tier(total_points)
+        # Running total and tier are kept in user_summary (see loyalty.py)
+        total_points, tier = get_summary(conn, user_id)
 
-        # Get all eligible rewards based on user's tier
-        cursor.execute('''
-            SELECT 
-                r.id,
-                r.type,
-                r.business_name,
-                r.name,
-                r.description,
-                r.points_required,
-                r.tier_required,
-                CASE 
-                    WHEN ur.id IS NOT NULL THEN 'claimed'
-                    ELSE 'available'
-                END as status
-            FROM rewards r
-            LEFT JOIN user_rewards ur ON 
-                r.id = ur.reward_id AND 
-                ur.user_id = ? AND 
-                ur.status != 'expired'
-            WHERE 
-                r.active = 1
-                AND (
-                    r.tier_required IS NULL 
-                    OR (
-                        CASE 
-                            WHEN r.tier_required = 'Bronze' THEN 1
-                            WHEN r.tier_required = 'Silver' THEN 2
-                            WHEN r.tier_required = 'Gold' THEN 3
-                        END <= 
-                        CASE 
-                            WHEN ? = 'Bronze' THEN 1
-                            WHEN ? = 'Silver' THEN 2
-                            WHEN ? = 'Gold' THEN 3
-                        END
-                    )
-                )
-                AND (r.points_required <= ?)
-                AND (ur.id IS NULL)  -- Only show unclaimed rewards
-        ''', (user_id, tier, tier, tier, total_points))
-
-        available_rewards = []
-        for reward in cursor.fetchall():
-            available_rewards.append({
-                'id': reward[0],
-                'type': reward[1],
-                'business_name': reward[2],
-                'name': reward[3],
-                'description': reward[4],
-                'points_required': reward[5],
-                'tier_required': reward[6],
-                'status': reward[7],
-                'icon': get_reward_icon(reward[1])
-            })
-
-        conn.close()
+        # Eligible, unclaimed rewards from the in-process catalog (see rewards_catalog.py)
+        available_rewards = [
+            dict(reward, status='available', icon=get_reward_icon(reward['type']))
+            for reward in rewards_catalog.eligible(conn, user_id, tier, total_points)
+        ]
 
         return jsonify({
             'success': True,
@@ -514,7 +1062,7 @@ def claim_reward():
         if not user_id or not reward_id:
             return jsonify({'error': 'Missing required fields'}), 400
 
-        conn = sqlite3.connect('face_recognition.db')
+        conn = get_db()
         cursor = conn.cursor()
 
         # Check if reward exists and is available
@@ -545,18 +1093,11 @@ def claim_reward():
             VALUES (?, ?, datetime('now'), ?, 'claimed')
         ''', (user_id, reward_id, expiry_date))
 
-        # If it's a points reward, add to points history
+        # A points reward is redeemed through the ledger and the user's points summary
         if reward[1] == 'points':
-            cursor.execute('''
-                INSERT INTO points_history (
-                    user_id, points_change, transaction_type, 
-                    description, transaction_date
-                )
-                VALUES (?, ?, 'redeem', ?, datetime('now'))
-            ''', (user_id, -reward[5], f"Claimed reward: {reward[3]}"))
+            record_points(conn, user_id, -reward[5], 'redeem', f"Claimed reward: {reward[3]}", reward[2])
 
         conn.commit()
-        conn.close()
 
         return jsonify({
             'success': True,
@@ -588,6 +1129,4 @@ def get_reward_icon(reward_type):
     return icons.get(reward_type, '🎁')
 
 if __name__ == '__main__':
-    init_loyalty_db()
-    init_rewards_db()  # Add this line
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,59 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches for one handler call.
+
+    The first request to arrive opens a window of `window_ms`; everything that
+    arrives before the window closes (or until `max_batch` requests are waiting)
+    is handed to `handler` as a single list, and the results are fanned back
+    out to the waiting callers in order.
+    """
+
+    def __init__(self, handler, window_ms=10, max_batch=16, name='micro-batcher'):
+        self.handler = handler
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def call(self, item, timeout=None):
+        """Submit one item and block until its batch has been processed"""
+        return self.submit(item).result(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self.handler(items)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,304 @@
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+
+# Rows per executemany call while filling a scratch users table
+INSERT_BATCH = 10000
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Settings for the per-size child process: the generated sample image would
+# otherwise stop at the quality gate as blurry and never reach detection, and
+# the endpoint run reads its stage breakdown from the Server-Timing header
+CHILD_ENV = {
+    'FACETAG_QUALITY_GATE_ENABLED': '0',
+    'FACETAG_METRICS_ENABLED': '1',
+    'FACETAG_METRICS_TIMING_HEADER': '1'
+}
+
+
+def create_scratch_db(db_path, size, seed=0):
+    """A users table holding `size` random unit-norm 128-d encodings"""
+    import migrations
+
+    migrations.migrate(db_path)
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(db_path)
+    for start in range(0, size, INSERT_BATCH):
+        count = min(INSERT_BATCH, size - start)
+        encodings = rng.normal(size=(count, 128))
+        encodings /= np.linalg.norm(encodings, axis=1, keepdims=True)
+        conn.executemany(
+            "INSERT INTO users (name, age, email, face_encoding) VALUES (?, ?, ?, ?)",
+            [(f'Member {start + i}', 18 + (start + i) % 60, f'member{start + i}@example.com', encoding.tobytes())
+             for i, encoding in enumerate(encodings)]
+        )
+    conn.commit()
+    conn.close()
+
+
+def probe_set(gallery, count, seed=1):
+    """Half near-duplicates of gallery rows (should match), half fresh vectors (should not)"""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), size=min(count // 2, len(gallery)), replace=False)
+    genuine = gallery.encodings[rows] + rng.normal(scale=0.02, size=(len(rows), 128))
+    impostors = rng.normal(size=(count - len(rows), 128))
+    impostors /= np.linalg.norm(impostors, axis=1, keepdims=True)
+    return np.vstack([genuine, impostors])
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def latency_summary(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        'count': len(ms),
+        'mean_ms': round(float(ms.mean()), 4),
+        'p50_ms': round(float(np.percentile(ms, 50)), 4),
+        'p95_ms': round(float(np.percentile(ms, 95)), 4),
+        'p99_ms': round(float(np.percentile(ms, 99)), 4),
+        'max_ms': round(float(ms.max()), 4)
+    }
+
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+
+def bench_load(db_path):
+    """DatabaseFaceRecognition.load_database with a cold (no snapshot) and a warm start"""
+    import app
+    from app import DatabaseFaceRecognition
+    from gallery_snapshot import snapshot_dir_for
+
+    # Keep the app's own background warm-up out of the timed loads
+    app.warm_up.wait()
+    shutil.rmtree(snapshot_dir_for(db_path), ignore_errors=True)
+    report = {}
+    recognizer = None
+    for phase in ('cold', 'warm'):
+        recognizer = None
+        rss_before = _rss_bytes()
+        tracemalloc.start()
+        seconds, recognizer = _timed(DatabaseFaceRecognition, db_path)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_after = _rss_bytes()
+        report[phase] = {
+            'seconds': round(seconds, 4),
+            'python_peak_bytes': peak,
+            'rss_delta_bytes': rss_after - rss_before if rss_before is not None else None
+        }
+    report['gallery_size'] = len(recognizer.gallery)
+    report['gallery_type'] = type(recognizer.gallery).__name__
+    return report, recognizer
+
+
+def bench_matching(recognizer, probes, batch=16, tolerance=0.6):
+    """Per-probe latency and batched throughput, gallery search alone and with the user lookup"""
+    search = [_timed(recognizer.nearest, probe[None, :])[0] for probe in probes]
+    match = [_timed(recognizer.match_encodings, probe[None, :], tolerance)[0] for probe in probes]
+
+    started = time.perf_counter()
+    matched = 0
+    for start in range(0, len(probes), batch):
+        matched += sum(bool(row) for row in recognizer.match_encodings(probes[start:start + batch], tolerance))
+    elapsed = time.perf_counter() - started
+    return {
+        'search_latency': latency_summary(search),
+        'match_latency': latency_summary(match),
+        'batch_size': batch,
+        'batched_probes_per_second': round(len(probes) / elapsed, 1),
+        'matched_probes': matched
+    }
+
+
+def bench_simple_facerec(recognizer, probes, max_probes=20):
+    """SimpleFacerec's list-based compare_faces / face_distance matching over the same gallery"""
+    import face_recognition
+    from simple_facerec import SimpleFacerec
+
+    sfr = SimpleFacerec()
+    sfr.known_face_encodings = list(recognizer.gallery.encodings)
+    sfr.known_face_names = [str(user_id) for user_id in recognizer.gallery.ids]
+
+    def match(probe):
+        matches = face_recognition.compare_faces(sfr.known_face_encodings, probe)
+        distances = face_recognition.face_distance(sfr.known_face_encodings, probe)
+        best = int(np.argmin(distances))
+        return sfr.known_face_names[best] if matches[best] else "Unknown"
+
+    return {'match_latency': latency_summary([_timed(match, probe)[0] for probe in probes[:max_probes]])}
+
+
+def sample_images(images_dir):
+    """Bundled sample photos when present, otherwise one generated JPEG"""
+    if images_dir and os.path.isdir(images_dir):
+        paths = sorted(os.path.join(images_dir, name) for name in os.listdir(images_dir)
+                       if name.lower().endswith(IMAGE_EXTENSIONS))
+        if paths:
+            images = []
+            for path in paths:
+                with open(path, 'rb') as f:
+                    images.append((os.path.basename(path), f.read()))
+            return images
+
+    import cv2
+    rng = np.random.default_rng(2)
+    frame = cv2.GaussianBlur(rng.integers(0, 255, size=(480, 640, 3), dtype=np.uint8), (0, 0), 3)
+    _, buffer = cv2.imencode('.jpg', frame)
+    return [('generated.jpg', buffer.tobytes())]
+
+
+def _stage_ms(header):
+    """{stage: milliseconds} from a Server-Timing header value"""
+    stages = {}
+    for part in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, _, duration = part.partition(';dur=')
+        if duration:
+            stages[name] = float(duration)
+    return stages
+
+
+def bench_endpoint(images, repeats=10):
+    """
+    End-to-end POST /api/identify through the Flask test client, with the mean
+    time per recognition stage taken from the Server-Timing header. Outcome
+    'no_face' means the image never got as far as encoding.
+    """
+    import app
+
+    app.warm_up.wait()
+    client = app.app.test_client()
+    report = {}
+    for name, image_bytes in images:
+        latencies = []
+        stages = {}
+        outcome = None
+        for _ in range(repeats):
+            started = time.perf_counter()
+            response = client.post('/api/identify', data=io.BytesIO(image_bytes), content_type='image/jpeg')
+            latencies.append(time.perf_counter() - started)
+            for stage, ms in _stage_ms(response.headers.get('Server-Timing')).items():
+                stages.setdefault(stage, []).append(ms)
+            body = response.get_json() or {}
+            outcome = body.get('user', {}).get('name') if body.get('success') else body.get('reason')
+        report[name] = dict(
+            latency_summary(latencies),
+            status=response.status_code,
+            outcome=outcome,
+            stage_ms={stage: round(float(np.mean(ms)), 4) for stage, ms in stages.items()}
+        )
+    return report
+
+
+def run_size(size, probes=200, images_dir=None, repeats=10, skip=()):
+    """
+    Benchmark one gallery size. Must run with the working directory set to a
+    scratch directory: app.py opens face_recognition.db relative to it.
+    """
+    db_path = 'face_recognition.db'
+    report = {'size': size}
+    seconds, _ = _timed(create_scratch_db, db_path, size)
+    report['populate_seconds'] = round(seconds, 3)
+    report['db_bytes'] = os.path.getsize(db_path)
+
+    report['load_database'], recognizer = bench_load(db_path)
+    probe_encodings = probe_set(recognizer.gallery, probes)
+    report['matching'] = bench_matching(recognizer, probe_encodings)
+
+    sections = (
+        ('simple_facerec', lambda: bench_simple_facerec(recognizer, probe_encodings)),
+        ('identify_endpoint', lambda: bench_endpoint(sample_images(images_dir), repeats))
+    )
+    for name, bench in sections:
+        if name in skip:
+            continue
+        try:
+            report[name] = bench()
+        except ImportError as e:
+            report[name] = {'skipped': f"missing dependency: {e}"}
+        except Exception as e:
+            report[name] = {'error': str(e)}
+    return report
+
+
+def run_suite(sizes, probes=200, images_dir=None, repeats=10, skip=(), keep=False):
+    """
+    Every size runs in its own interpreter inside its own scratch directory, so
+    load times and memory are not skewed by earlier runs
+    """
+    images_dir = os.path.abspath(images_dir) if images_dir else None
+    results = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': []
+    }
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix=f'facetag-bench-{size}-')
+        command = [sys.executable, os.path.abspath(__file__), '--single', str(size),
+                   '--probes', str(probes), '--repeats', str(repeats)]
+        if images_dir:
+            command += ['--images', images_dir]
+        for name in skip:
+            command += ['--skip', name]
+        print(f"Benchmarking {size} encodings in {workdir}", file=sys.stderr)
+        completed = subprocess.run(command, cwd=workdir, capture_output=True, text=True,
+                                   env=dict(os.environ, **CHILD_ENV))
+        if completed.returncode != 0:
+            results['runs'].append({'size': size, 'error': completed.stderr.strip().splitlines()[-1:]})
+        else:
+            results['runs'].append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recognition benchmarks over synthetic galleries")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--probes', type=int, default=200, help="probe encodings per size")
+    parser.add_argument('--images', default='images', help="sample photos for the /api/identify run")
+    parser.add_argument('--repeats', type=int, default=10, help="requests per sample image")
+    parser.add_argument('--skip', action='append', default=[], choices=('simple_facerec', 'identify_endpoint'))
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch databases")
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        # Child process: everything app.py prints goes to stderr, the last stdout line is the report
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        report = run_size(args.single, args.probes, args.images, args.repeats, args.skip)
+        print(json.dumps(report), file=stdout)
+    else:
+        results = run_suite(args.sizes, args.probes, args.images, args.repeats, args.skip, args.keep)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
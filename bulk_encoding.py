@@ -0,0 +1,264 @@
+import functools
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from detection import encode_crops
+from face_pipeline import decode_image_bytes, detect_faces
+from quality import NO_FACE
+from startup import worker_context
+
+# Outcomes of encoding one image; anything but OK is skipped and reported
+OK = 'ok'
+MULTIPLE_FACES = 'multiple_faces'
+UNREADABLE = 'unreadable'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+# Cache file created inside the image directory; its extension keeps it out of list_images
+CACHE_FILENAME = '.encodings_cache.db'
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 2.0
+
+
+def content_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+# Read-only cache connections opened lazily inside each worker process
+_worker_caches = {}
+
+
+def _cached_by_hash(cache_path, digest):
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    conn = _worker_caches.get(cache_path)
+    if conn is None:
+        conn = _worker_caches[cache_path] = sqlite3.connect(f'file:{cache_path}?mode=ro', uri=True)
+    row = conn.execute(
+        "SELECT status, encoding FROM encodings WHERE sha256 = ? LIMIT 1", (digest,)).fetchone()
+    if row is None:
+        return None
+    return row[0], EncodingCache._decode(row[1])
+
+
+def encode_file(path, cache_path=None):
+    """
+    Worker task: read, hash and encode one image that must hold exactly one face.
+    Content already in the cache under another path or mtime is not re-encoded.
+    :return: (path, sha256, status, encoding or None)
+    """
+    try:
+        with open(path, 'rb') as f:
+            image_bytes = f.read()
+    except OSError:
+        return path, None, UNREADABLE, None
+    digest = content_hash(image_bytes)
+
+    cached = _cached_by_hash(cache_path, digest)
+    if cached is not None:
+        return (path, digest) + cached
+
+    try:
+        frame = decode_image_bytes(image_bytes)
+    except ValueError:
+        return path, digest, UNREADABLE, None
+
+    face_locations = detect_faces(frame)
+    if not face_locations:
+        return path, digest, NO_FACE, None
+    if len(face_locations) > 1:
+        return path, digest, MULTIPLE_FACES, None
+    return path, digest, OK, encode_crops(frame, face_locations)[0]
+
+
+class EncodingCache:
+    """
+    Encodings of previously seen image files, in a small SQLite file.
+
+    A file whose path, size and mtime are unchanged is trusted without reading
+    it. Any other file is hashed by the worker that reads it and matched by
+    content first, so touched, copied or renamed files are not re-encoded. Rejections (no face,
+    several faces) are cached too, so bad photos are not re-examined every start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS encodings (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                sha256 TEXT NOT NULL,
+                status TEXT NOT NULL,
+                encoding BLOB
+            )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_encodings_sha256 ON encodings(sha256)")
+        self.conn.commit()
+
+    def lookup(self, path, stat):
+        """Cached (status, encoding) for an unchanged file, or None"""
+        row = self.conn.execute(
+            "SELECT size, mtime, status, encoding FROM encodings WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return row[2], self._decode(row[3])
+        return None
+
+    def store(self, path, stat, digest, status, encoding):
+        blob = None if encoding is None else np.asarray(encoding, dtype=np.float64).tobytes()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO encodings (path, size, mtime, sha256, status, encoding) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime, digest, status, blob)
+        )
+
+    def prune(self, keep_paths):
+        """Forget files that are no longer in the directory"""
+        known = [row[0] for row in self.conn.execute("SELECT path FROM encodings")]
+        stale = [(path,) for path in known if path not in keep_paths]
+        self.conn.executemany("DELETE FROM encodings WHERE path = ?", stale)
+        return len(stale)
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    @staticmethod
+    def _decode(blob):
+        return None if blob is None else np.frombuffer(blob, dtype=np.float64)
+
+
+def list_images(images_path):
+    return sorted(
+        path for path in (os.path.join(images_path, name) for name in os.listdir(images_path))
+        if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS)
+    )
+
+
+class _Progress:
+    def __init__(self, total, report):
+        self.total = total
+        self.report = report
+        self.done = 0
+        self.started = time.perf_counter()
+        self._last = self.started
+
+    def step(self):
+        self.done += 1
+        now = time.perf_counter()
+        if self.report and (now - self._last >= PROGRESS_INTERVAL or self.done == self.total):
+            self._last = now
+            elapsed = now - self.started
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            self.report(f"Encoded {self.done}/{self.total} images ({rate:.1f} images/s)")
+
+
+def iter_encodings(paths, cache=None, workers=None, progress=print, stats=None, commit_every=1000):
+    """
+    Encode many images across a process pool, reusing cached encodings. Results
+    stream back in input order and the cache is committed every `commit_every`
+    images, so an interrupted run resumes from where it stopped.
+    :param paths: image files
+    :param cache: EncodingCache or None
+    :param workers: pool size, defaults to every core
+    :param progress: callable(str) for progress lines, or None
+    :param stats: dict filled with counters once the generator is exhausted
+    :return: generator of (path, status, encoding or None)
+    """
+    started = time.perf_counter()
+    hits = skipped = encoded = 0
+    outcomes = {}
+    stats_by_path = {}
+    pending = []
+
+    for path in paths:
+        try:
+            stats_by_path[path] = os.stat(path)
+        except OSError:
+            outcomes[path] = (UNREADABLE, None)
+            continue
+        cached = cache.lookup(path, stats_by_path[path]) if cache is not None else None
+        if cached is None:
+            pending.append(path)
+        else:
+            outcomes[path] = cached
+            hits += 1
+
+    tracker = _Progress(len(pending), progress)
+    executor = None
+    try:
+        if pending:
+            workers = max(1, min(workers or os.cpu_count() or 1, len(pending)))
+            executor = ProcessPoolExecutor(max_workers=workers, mp_context=worker_context())
+            chunksize = max(1, min(16, len(pending) // (workers * 4)))
+            task = functools.partial(encode_file, cache_path=cache.path if cache is not None else None)
+            results = executor.map(task, pending, chunksize=chunksize)
+        else:
+            results = iter(())
+
+        pending_set = set(pending)
+        for path in paths:
+            if path in pending_set:
+                _, digest, status, encoding = next(results)
+                encoded += 1
+                if cache is not None and digest is not None:
+                    cache.store(path, stats_by_path[path], digest, status, encoding)
+                    if encoded % commit_every == 0:
+                        cache.commit()
+                tracker.step()
+            else:
+                status, encoding = outcomes.pop(path)
+            if status != OK:
+                skipped += 1
+            yield path, status, encoding
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if cache is not None:
+            cache.commit()
+
+    if stats is not None:
+        elapsed = time.perf_counter() - started
+        stats.update({
+            'images': len(paths),
+            'cached': hits,
+            'encoded': encoded,
+            'loaded': len(paths) - skipped,
+            'skipped': skipped,
+            'seconds': round(elapsed, 3),
+            'images_per_second': round(encoded / elapsed, 2) if elapsed > 0 else 0.0
+        })
+
+
+def encode_paths(paths, cache=None, workers=None, progress=print):
+    """
+    Encode many images, see iter_encodings
+    :return: (results, stats) where results is [(path, status, encoding or None)] in input order
+    """
+    stats = {}
+    results = list(iter_encodings(paths, cache=cache, workers=workers, progress=progress, stats=stats))
+    return results, stats
+
+
+def encode_directory(images_path, workers=None, use_cache=True, progress=print):
+    """Encode every image in a directory; the cache lives inside it as CACHE_FILENAME"""
+    paths = list_images(images_path)
+    cache = EncodingCache(os.path.join(images_path, CACHE_FILENAME)) if use_cache else None
+    try:
+        results, stats = encode_paths(paths, cache=cache, workers=workers, progress=progress)
+        if cache is not None:
+            stats['pruned'] = cache.prune(set(paths))
+    finally:
+        if cache is not None:
+            cache.close()
+    return results, stats
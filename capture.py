@@ -0,0 +1,166 @@
+import threading
+import time
+import cv2
+
+
+class LatestSlot:
+    """
+    One-slot buffer: a put replaces whatever has not been taken yet, so the
+    consumer always gets the newest item and never works through a backlog.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._fresh = False
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._fresh:
+                self.dropped += 1
+            self._item = item
+            self._fresh = True
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Newest item not yet taken, or None on timeout / close"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._fresh or self._closed, timeout=timeout):
+                return None
+            if not self._fresh:
+                return None
+            self._fresh = False
+            return self._item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def pending(self):
+        return self._fresh
+
+
+class StageTimer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(1000 * self.total / self.count, 2) if self.count else 0.0,
+            'max_ms': round(1000 * self.max, 2)
+        }
+
+
+class PipelinedCapture:
+    """
+    Capture -> inference -> display split across threads.
+
+    A reader thread keeps only the newest camera frame, an inference thread
+    runs `infer(frame)` on whatever is newest when it becomes free, and the
+    caller (normally the main thread, which owns the imshow window) picks up
+    the newest result with latest(). Decisions are therefore never more than
+    one inference behind the camera, however slow inference is.
+    """
+
+    def __init__(self, source, infer):
+        self.cap = source if isinstance(source, cv2.VideoCapture) else cv2.VideoCapture(source)
+        self.infer = infer
+        self.frames = LatestSlot()
+        self.results = LatestSlot()
+        self.timers = {name: StageTimer() for name in ('capture', 'inference', 'display', 'end_to_end')}
+        self.captured = 0
+        self._running = False
+        self._threads = []
+        self._started = None
+
+    def is_opened(self):
+        return self.cap.isOpened()
+
+    def start(self):
+        self._running = True
+        self._started = time.perf_counter()
+        self._threads = [
+            threading.Thread(target=self._read_loop, name='capture-reader', daemon=True),
+            threading.Thread(target=self._infer_loop, name='capture-inference', daemon=True)
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _read_loop(self):
+        while self._running:
+            started = time.perf_counter()
+            ret, frame = self.cap.read()
+            if not ret:
+                break
+            captured_at = time.perf_counter()
+            self.timers['capture'].add(captured_at - started)
+            self.captured += 1
+            self.frames.put((captured_at, frame))
+        self.frames.close()
+
+    def _infer_loop(self):
+        while self._running:
+            item = self.frames.get(timeout=0.5)
+            if item is None:
+                if self.frames.closed:
+                    break
+                continue
+            captured_at, frame = item
+            started = time.perf_counter()
+            result = self.infer(frame)
+            self.timers['inference'].add(time.perf_counter() - started)
+            self.results.put((captured_at, frame, result))
+        self.results.close()
+
+    def latest(self, timeout=None):
+        """
+        Newest (frame, result) from the inference stage, or None if nothing new
+        arrived within the timeout or the stream has ended
+        """
+        item = self.results.get(timeout=timeout)
+        if item is None:
+            return None
+        captured_at, frame, result = item
+        self.timers['end_to_end'].add(time.perf_counter() - captured_at)
+        return frame, result
+
+    def record_display(self, seconds):
+        self.timers['display'].add(seconds)
+
+    @property
+    def finished(self):
+        return self.results.closed and not self.results.pending
+
+    def stop(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join(timeout=2.0)
+        self.cap.release()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        processed = self.timers['inference'].count
+        return {
+            'captured_frames': self.captured,
+            'processed_frames': processed,
+            'dropped_frames': self.frames.dropped,
+            'effective_fps': round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+            'stages': {name: timer.summary() for name, timer in self.timers.items()}
+        }
@@ -22,11 +22,16 @@ def clear_database():
         cursor.execute("SELECT COUNT(*) FROM points_history")
         initial_points_history_count = cursor.fetchone()[0]
         
+        cursor.execute("SELECT COUNT(*) FROM face_templates")
+        initial_templates_count = cursor.fetchone()[0]
+        
         # Delete all records from tables (order matters due to foreign key constraints)
         cursor.execute("DELETE FROM points_history")
+        cursor.execute("DELETE FROM user_summary")
         cursor.execute("DELETE FROM user_rewards")
         cursor.execute("DELETE FROM loyalty_cards")
         cursor.execute("DELETE FROM rewards")
+        cursor.execute("DELETE FROM face_templates")
         cursor.execute("DELETE FROM users")
         
         # Commit the changes
@@ -38,6 +43,7 @@ def clear_database():
         print(f"Initial number of rewards: {initial_rewards_count}")
         print(f"Initial number of claimed rewards: {initial_user_rewards_count}")
         print(f"Initial number of point transactions: {initial_points_history_count}")
+        print(f"Initial number of face templates: {initial_templates_count}")
         print("\nAll records have been deleted successfully!")
         print("The database table structure has been preserved.")
         
@@ -51,7 +57,7 @@ def clear_database():
 
 if __name__ == "__main__":
     print("\nWARNING: This will delete ALL data including:")
-    print("- Users and their face encodings")
+    print("- Users and their face encodings and templates")
     print("- Loyalty cards and points")
     print("- Rewards and claimed rewards")
     print("- Points history")
@@ -0,0 +1,470 @@
+import argparse
+import json
+import sqlite3
+import time
+import numpy as np
+
+from gallery import FaceGallery, ENCODING_DIM, _IdLookup, decode_encodings, encoding_blob
+from gallery_snapshot import load_gallery, snapshot_dir_for, write_snapshot
+
+PRECISIONS = ('float32', 'int8')
+
+# Rows dequantized per matmul when scanning an int8 gallery
+SCAN_BLOCK = 65536
+
+# Rows rewritten per executemany call during a blob migration
+MIGRATE_BATCH = 10000
+
+# Rows a generation may add past its buffer's id lookup before the lookup is rebuilt
+LOOKUP_SLACK = 4096
+
+
+def _squared_norms(encodings):
+    return np.einsum('ij,ij->i', encodings, encodings)
+
+
+def int8_scales(blocks):
+    """
+    Symmetric per-dimension scales so each dimension's largest magnitude maps to 127
+    :param blocks: iterable of (n, 128) encoding blocks
+    """
+    peak = np.zeros(ENCODING_DIM, dtype=np.float64)
+    for block in blocks:
+        np.maximum(peak, np.abs(block).max(axis=0), out=peak)
+    peak[peak == 0] = 1.0
+    return (peak / 127.0).astype(np.float32)
+
+
+class _Rows:
+    """Over-allocated compact rows, appended in place by the newest generation only"""
+
+    def __init__(self, ids, codes, sq_norms):
+        self.ids = ids
+        self.codes = codes
+        self.sq_norms = sq_norms
+        self.size = len(ids)
+        # _IdLookup over a prefix of ids, shared by the generations of this buffer
+        self.lookup = None
+
+    @property
+    def capacity(self):
+        return len(self.ids)
+
+    def grow(self, size, capacity):
+        rows = _Rows(
+            np.empty(capacity, dtype=np.int64),
+            np.empty((capacity, ENCODING_DIM), dtype=self.codes.dtype),
+            np.empty(capacity, dtype=np.float32)
+        )
+        rows.ids[:size] = self.ids[:size]
+        rows.codes[:size] = self.codes[:size]
+        rows.sq_norms[:size] = self.sq_norms[:size]
+        rows.size = size
+        return rows
+
+
+class CompactGallery:
+    """
+    FaceGallery drop-in that holds encodings as float32 (half the memory) or as
+    int8 with one scale per dimension (an eighth). Scans run on the compact
+    form in float32; the `rerank` best candidates per probe can then be
+    re-scored exactly against `exact`, a float64 FaceGallery that is normally
+    the memory-mapped snapshot, so only the candidate rows are ever paged in.
+
+    Like FaceGallery, a generation is never modified once published.
+    """
+
+    def __init__(self, ids, codes, scales=None, exact=None, rerank=0):
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        codes = np.ascontiguousarray(codes).reshape(-1, ENCODING_DIM)
+        if codes.dtype not in (np.float32, np.int8):
+            raise ValueError(f"Unsupported compact dtype {codes.dtype}")
+        if codes.dtype == np.int8 and scales is None:
+            raise ValueError("int8 codes need per-dimension scales")
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float32)
+        self.exact = exact
+        self.rerank = rerank
+        self._rows = _Rows(ids, codes, self._code_norms(codes))
+        self._size = len(ids)
+        self._tail_lookup = None
+
+    @classmethod
+    def from_gallery(cls, gallery, precision='int8', rerank=0, keep_exact=True):
+        """
+        Compact copy of a float64 FaceGallery, converted block by block straight
+        from its segments, so a memory-mapped base is never copied whole
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {PRECISIONS}")
+        scales = None
+        if precision == 'int8':
+            scales = int8_scales(block for _, block in gallery.blocks(SCAN_BLOCK))
+        ids = np.empty(len(gallery), dtype=np.int64)
+        codes = np.empty((len(gallery), ENCODING_DIM), dtype=precision)
+        start = 0
+        for block_ids, block in gallery.blocks(SCAN_BLOCK):
+            ids[start:start + len(block)] = block_ids
+            codes[start:start + len(block)] = cls._quantize(block, scales)
+            start += len(block)
+        return cls(ids, codes, scales, exact=gallery if keep_exact else None, rerank=rerank)
+
+    @staticmethod
+    def _quantize(encodings, scales):
+        if scales is None:
+            return np.asarray(encodings, dtype=np.float32)
+        return np.clip(np.rint(np.asarray(encodings) / scales), -127, 127).astype(np.int8)
+
+    def _dequantize(self, codes):
+        if self.scales is None:
+            return codes.astype(np.float32, copy=False)
+        return codes.astype(np.float32) * self.scales
+
+    def _code_norms(self, codes):
+        norms = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCAN_BLOCK):
+            block = self._dequantize(codes[start:start + SCAN_BLOCK])
+            norms[start:start + len(block)] = _squared_norms(block)
+        return norms
+
+    @property
+    def precision(self):
+        return self._rows.codes.dtype.name
+
+    @property
+    def ids(self):
+        return self._rows.ids[:self._size]
+
+    @property
+    def codes(self):
+        return self._rows.codes[:self._size]
+
+    @property
+    def encodings(self):
+        """Dequantized float64 rows, for consumers such as ANN training that want plain vectors"""
+        return self._dequantize(self.codes).astype(np.float64)
+
+    @property
+    def nbytes(self):
+        """Resident size of the searchable rows"""
+        return self.ids.nbytes + self.codes.nbytes + self._rows.sq_norms[:self._size].nbytes
+
+    def __len__(self):
+        return self._size
+
+    def _locate(self, user_ids):
+        """
+        Row of each user id, -1 if it is not in the gallery. The buffer keeps one
+        lookup over the rows it held when it was built; rows appended since are
+        looked up per generation until they outgrow LOOKUP_SLACK.
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64).reshape(-1)
+        lookup = self._rows.lookup
+        if lookup is None or len(lookup.ids) > self._size or \
+                self._size - len(lookup.ids) > LOOKUP_SLACK:
+            # An older generation sharing the buffer must not see newer rows
+            lookup = _IdLookup(self.ids)
+            if self._rows.size == self._size:
+                self._rows.lookup = lookup
+        rows = lookup.find(user_ids)
+        if len(lookup.ids) < self._size:
+            if self._tail_lookup is None:
+                self._tail_lookup = _IdLookup(self.ids[len(lookup.ids):])
+            # Later rows are newer, so they win
+            tail_rows = self._tail_lookup.find(user_ids)
+            rows = np.where(tail_rows >= 0, tail_rows + len(lookup.ids), rows)
+        return rows
+
+    def contains(self, user_ids):
+        """Boolean mask: which of user_ids are in the gallery"""
+        return self._locate(user_ids) >= 0
+
+    def _derive(self, rows, size, exact):
+        gallery = CompactGallery.__new__(CompactGallery)
+        gallery.scales = self.scales
+        gallery.exact = exact
+        gallery.rerank = self.rerank
+        gallery._rows = rows
+        gallery._size = size
+        gallery._tail_lookup = None
+        return gallery
+
+    def with_added(self, ids, encodings):
+        """New generation with extra rows, quantized with the existing scales"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        if not len(ids):
+            return self
+
+        size = self._size
+        needed = size + len(ids)
+        rows = self._rows
+        # Appending in place is only safe from the newest generation of a buffer
+        if rows.size != size or needed > rows.capacity:
+            rows = rows.grow(size, max(needed, 2 * size, 64))
+
+        codes = self._quantize(encodings, self.scales)
+        rows.ids[size:needed] = ids
+        rows.codes[size:needed] = codes
+        rows.sq_norms[size:needed] = self._code_norms(codes)
+        rows.size = needed
+
+        exact = self.exact.with_added(ids, encodings) if self.exact is not None else None
+        return self._derive(rows, needed, exact)
+
+    def with_removed(self, ids):
+        """New generation without the given user ids; the exact reference keeps its rows"""
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        if keep.all():
+            return self
+        rows = _Rows(self.ids[keep], self.codes[keep], self._rows.sq_norms[:self._size][keep])
+        return self._derive(rows, rows.size, self.exact)
+
+    def subset(self, user_ids):
+        """New gallery holding only the given user ids, sharing scales and the exact reference"""
+        keep = np.isin(self.ids, np.asarray(user_ids, dtype=np.int64))
+        rows = _Rows(self.ids[keep], self.codes[keep], self._rows.sq_norms[:self._size][keep])
+        return self._derive(rows, rows.size, self.exact)
+
+    def distances(self, probes):
+        """
+        Approximate Euclidean distance from every probe to every row, in float32
+        :return: (P, N) distance matrix
+        """
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        probe_sq_norms = _squared_norms(probes)
+        # For int8, fold the scales into the probes: q.(c*s) == (q*s).c
+        scaled = probes if self.scales is None else probes * self.scales
+
+        sq_dist = np.empty((len(probes), self._size), dtype=np.float32)
+        codes, sq_norms = self.codes, self._rows.sq_norms[:self._size]
+        for start in range(0, self._size, SCAN_BLOCK):
+            block = codes[start:start + SCAN_BLOCK]
+            out = sq_dist[:, start:start + len(block)]
+            np.matmul(scaled, block.T.astype(np.float32, copy=False), out=out)
+            out *= -2.0
+            out += probe_sq_norms[:, None]
+            out += sq_norms[None, start:start + len(block)]
+
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        return np.sqrt(sq_dist, out=sq_dist)
+
+    def _exact_rows(self, user_ids):
+        """
+        float64 encodings of the given ids from the exact reference, looked up
+        per segment: only the candidate rows of the mapped snapshot are read.
+        A moved centroid is re-added after its old row; the newest row is current.
+        """
+        return self.exact.encodings_for(user_ids)
+
+    def search(self, probes, k=1):
+        """
+        Top-k nearest identities per probe; same contract as FaceGallery.search
+        :return: list (one entry per probe) of [(user_id, distance), ...] sorted by distance
+        """
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        if self._size == 0:
+            return [[] for _ in range(len(probes))]
+
+        rerank = self.exact is not None and self.rerank > 0
+        candidates = min(max(k, self.rerank) if rerank else k, self._size)
+        dist = self.distances(probes)
+        if candidates < self._size:
+            top = np.argpartition(dist, candidates - 1, axis=1)[:, :candidates]
+        else:
+            top = np.broadcast_to(np.arange(self._size), dist.shape)
+        top_ids = self.ids[top]
+
+        if rerank:
+            exact = self._exact_rows(top_ids.reshape(-1)).reshape(len(probes), candidates, ENCODING_DIM)
+            top_dist = np.linalg.norm(exact - probes[:, None, :], axis=2)
+        else:
+            top_dist = np.take_along_axis(dist, top, axis=1).astype(np.float64)
+
+        order = np.argsort(top_dist, axis=1)[:, :k]
+        top_ids = np.take_along_axis(top_ids, order, axis=1)
+        top_dist = np.take_along_axis(top_dist, order, axis=1)
+        return [
+            [(int(user_id), float(d)) for user_id, d in zip(row_ids, row_dist)]
+            for row_ids, row_dist in zip(top_ids, top_dist)
+        ]
+
+    def search_among(self, probe, user_ids, k=1):
+        """
+        Top-k for one probe among the given candidate ids only (e.g. from an ANN
+        index), scored on the compact codes and re-ranked like search
+        :return: [(user_id, distance), ...] sorted by distance
+        """
+        probe = np.asarray(probe, dtype=np.float64).reshape(ENCODING_DIM)
+        rows = self._locate(user_ids)
+        rows = rows[rows >= 0]
+        if not len(rows):
+            return []
+        candidate_ids = self._rows.ids[rows]
+
+        block = self._dequantize(self._rows.codes[rows])
+        query = probe.astype(np.float32)
+        sq_dist = self._rows.sq_norms[rows] + _squared_norms(query[None, :]) - 2.0 * (block @ query)
+        dist = np.sqrt(np.maximum(sq_dist, 0.0)).astype(np.float64)
+
+        if self.exact is not None and self.rerank > 0:
+            candidates = min(max(k, self.rerank), len(rows))
+            top = np.argpartition(dist, candidates - 1)[:candidates]
+            candidate_ids = candidate_ids[top]
+            dist = np.linalg.norm(self._exact_rows(candidate_ids) - probe, axis=1)
+        order = np.argsort(dist)[:k]
+        return [(int(candidate_ids[j]), float(dist[j])) for j in order]
+
+    def best_match(self, probes, tolerance=0.6):
+        """
+        Closest identity over all probes, or None if nothing is within tolerance
+        :return: (user_id, distance) or None
+        """
+        best = None
+        for neighbours in self.search(probes, k=1):
+            if neighbours and neighbours[0][1] <= tolerance:
+                if best is None or neighbours[0][1] < best[1]:
+                    best = neighbours[0]
+        return best
+
+
+def migrate_blobs(db_path='face_recognition.db', storage='float32', vacuum=False):
+    """
+    Rewrite every users.face_encoding blob in place at the given width, in one
+    transaction. float32 halves the column; readers accept both widths, so the
+    migration can run while the app is up. Rewrites the gallery snapshot after.
+    :return: number of rows rewritten
+    """
+    target = np.dtype(storage).itemsize * ENCODING_DIM
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute(
+            "SELECT id, face_encoding FROM users WHERE length(face_encoding) != ?", (target,))
+        rewritten = 0
+        while True:
+            rows = cursor.fetchmany(MIGRATE_BATCH)
+            if not rows:
+                break
+            encodings = decode_encodings(blob for _, blob in rows)
+            conn.executemany(
+                "UPDATE users SET face_encoding = ? WHERE id = ?",
+                [(encoding_blob(encoding, storage), user_id)
+                 for (user_id, _), encoding in zip(rows, encodings)]
+            )
+            rewritten += len(rows)
+        conn.commit()
+        if vacuum:
+            conn.execute("VACUUM")
+        if rewritten:
+            write_snapshot(conn, snapshot_dir_for(db_path))
+    finally:
+        conn.close()
+    print(f"Rewrote {rewritten} face encodings as {storage}")
+    return rewritten
+
+
+def synthetic_gallery(size, seed=0):
+    """Random unit-norm encodings, about the spread of real dlib encodings"""
+    rng = np.random.default_rng(seed)
+    encodings = rng.normal(size=(size, ENCODING_DIM))
+    encodings /= np.linalg.norm(encodings, axis=1, keepdims=True)
+    return FaceGallery(np.arange(1, size + 1), encodings)
+
+
+def benchmark_probes(gallery, count=500, seed=1):
+    """
+    Mix of genuine probes (gallery rows plus noise, straddling the tolerance)
+    and impostors (fresh random vectors)
+    """
+    rng = np.random.default_rng(seed)
+    genuine = count * 3 // 4
+    rows = rng.choice(len(gallery), size=min(genuine, len(gallery)), replace=False)
+    noise = rng.normal(size=(len(rows), ENCODING_DIM)) * rng.uniform(0.02, 0.07, size=(len(rows), 1))
+    impostors = rng.normal(size=(count - len(rows), ENCODING_DIM))
+    impostors /= np.linalg.norm(impostors, axis=1, keepdims=True)
+    return np.vstack([gallery.encodings[rows] + noise, impostors])
+
+
+def _decisions(gallery, probes, tolerance):
+    decisions, distances = [], []
+    for neighbours in gallery.search(probes, k=1):
+        user_id, distance = neighbours[0]
+        decisions.append(user_id if distance <= tolerance else None)
+        distances.append(distance)
+    return decisions, np.array(distances)
+
+
+def _latency_ms(gallery, probes, batch, repeats):
+    started = time.perf_counter()
+    calls = 0
+    for _ in range(repeats):
+        for start in range(0, len(probes), batch):
+            gallery.search(probes[start:start + batch], k=1)
+            calls += 1
+    return round(1000 * (time.perf_counter() - started) / calls, 3)
+
+
+def benchmark(gallery, probes, tolerance=0.6, rerank=8, repeats=3):
+    """
+    Memory, search latency and match agreement of each compact mode against the
+    float64 baseline. Agreement counts probes whose decision at `tolerance`
+    (matched user id, or no match) is identical to the baseline's.
+    """
+    baseline_decisions, baseline_distances = _decisions(gallery, probes, tolerance)
+    baseline_bytes = gallery.ids.nbytes + gallery.encodings.nbytes + gallery.sq_norms.nbytes
+    report = {
+        'gallery_size': len(gallery),
+        'probes': len(probes),
+        'tolerance': tolerance,
+        'modes': {
+            'float64': {
+                'bytes': int(baseline_bytes),
+                'latency_ms_batch_1': _latency_ms(gallery, probes[:100], 1, repeats),
+                'latency_ms_batch_16': _latency_ms(gallery, probes, 16, repeats),
+                'matched': sum(d is not None for d in baseline_decisions)
+            }
+        }
+    }
+
+    for precision in PRECISIONS:
+        for mode_rerank in (0, rerank):
+            started = time.perf_counter()
+            compact = CompactGallery.from_gallery(gallery, precision, rerank=mode_rerank)
+            build_seconds = time.perf_counter() - started
+            decisions, distances = _decisions(compact, probes, tolerance)
+            agree = sum(a == b for a, b in zip(decisions, baseline_decisions))
+            name = precision + (f'+rerank{mode_rerank}' if mode_rerank else '')
+            report['modes'][name] = {
+                'bytes': int(compact.nbytes),
+                'memory_ratio': round(compact.nbytes / baseline_bytes, 3),
+                'build_seconds': round(build_seconds, 3),
+                'latency_ms_batch_1': _latency_ms(compact, probes[:100], 1, repeats),
+                'latency_ms_batch_16': _latency_ms(compact, probes, 16, repeats),
+                'agreement': round(agree / len(probes), 4),
+                'max_distance_error': round(float(np.abs(distances - baseline_distances).max()), 5)
+            }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact gallery storage: benchmark and blob migration")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    bench = subparsers.add_parser('benchmark', help="compare float32 / int8 against float64")
+    bench.add_argument('--db', help="benchmark the registered users instead of a synthetic gallery")
+    bench.add_argument('--size', type=int, default=100000, help="synthetic gallery size")
+    bench.add_argument('--probes', type=int, default=500)
+    bench.add_argument('--tolerance', type=float, default=0.6)
+    bench.add_argument('--rerank', type=int, default=8)
+
+    migrate = subparsers.add_parser('migrate', help="rewrite face_encoding blobs in place")
+    migrate.add_argument('--db', default='face_recognition.db')
+    migrate.add_argument('--storage', choices=('float32', 'float64'), default='float32')
+    migrate.add_argument('--vacuum', action='store_true', help="reclaim the freed space afterwards")
+
+    args = parser.parse_args()
+    if args.command == 'benchmark':
+        gallery = load_gallery(args.db)[0] if args.db else synthetic_gallery(args.size)
+        probes = benchmark_probes(gallery, args.probes)
+        print(json.dumps(benchmark(gallery, probes, args.tolerance, args.rerank), indent=2))
+    else:
+        migrate_blobs(args.db, args.storage, args.vacuum)
@@ -0,0 +1,83 @@
+import os
+
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+# Approximate nearest-neighbour index over the face gallery
+ANN_ENABLED = _env_bool('FACETAG_ANN_ENABLED', False)
+ANN_MIN_GALLERY_SIZE = _env_int('FACETAG_ANN_MIN_GALLERY_SIZE', 50000)
+ANN_NPROBE = _env_int('FACETAG_ANN_NPROBE', 8)
+# Seconds between an ANN index change and saving the index for the next start
+ANN_SAVE_DELAY = _env_float('FACETAG_ANN_SAVE_DELAY', 30.0)
+
+# Seconds between checks of the users table for rows written by other processes
+GALLERY_REFRESH_INTERVAL = _env_float('FACETAG_GALLERY_REFRESH_INTERVAL', 2.0)
+
+# Micro-batching of concurrent /api/identify requests
+IDENTIFY_BATCH_ENABLED = _env_bool('FACETAG_IDENTIFY_BATCH_ENABLED', True)
+IDENTIFY_BATCH_WINDOW_MS = _env_float('FACETAG_IDENTIFY_BATCH_WINDOW_MS', 10.0)
+IDENTIFY_MAX_BATCH = _env_int('FACETAG_IDENTIFY_MAX_BATCH', 16)
+IDENTIFY_TIMEOUT = _env_float('FACETAG_IDENTIFY_TIMEOUT', 30.0)
+
+# Recognition worker processes (0 runs detection and encoding in the request thread)
+RECOGNITION_WORKERS = _env_int('FACETAG_RECOGNITION_WORKERS', 0)
+RECOGNITION_QUEUE_DEPTH = _env_int('FACETAG_RECOGNITION_QUEUE_DEPTH', 32)
+RECOGNITION_TIMEOUT = _env_float('FACETAG_RECOGNITION_TIMEOUT', 10.0)
+
+# Resolution face detection runs at on the server (see detection.DetectionPolicy)
+DETECTION_MODE = os.environ.get('FACETAG_DETECTION_MODE', 'max_side')
+DETECTION_SCALE = _env_float('FACETAG_DETECTION_SCALE', 0.25)
+DETECTION_MAX_SIDE = _env_int('FACETAG_DETECTION_MAX_SIDE', 640)
+DETECTION_MIN_FACE_PX = _env_int('FACETAG_DETECTION_MIN_FACE_PX', 120)
+
+# Quality gate in front of detection for /api/identify frames (see quality.FrameGate)
+QUALITY_GATE_ENABLED = _env_bool('FACETAG_QUALITY_GATE_ENABLED', True)
+QUALITY_MIN_FACE_PX = _env_int('FACETAG_QUALITY_MIN_FACE_PX', 80)
+QUALITY_MIN_SHARPNESS = _env_float('FACETAG_QUALITY_MIN_SHARPNESS', 50.0)
+QUALITY_MIN_BRIGHTNESS = _env_int('FACETAG_QUALITY_MIN_BRIGHTNESS', 40)
+QUALITY_MAX_BRIGHTNESS = _env_int('FACETAG_QUALITY_MAX_BRIGHTNESS', 220)
+QUALITY_CASCADE_PATH = os.environ.get('FACETAG_QUALITY_CASCADE_PATH')
+
+# Streaming identify sessions
+SESSION_REQUIRED_VOTES = _env_int('FACETAG_SESSION_REQUIRED_VOTES', 3)
+SESSION_TTL = _env_float('FACETAG_SESSION_TTL', 60.0)
+
+# In-memory gallery precision: 'float64', 'float32' or 'int8' (see compact_gallery.py)
+GALLERY_PRECISION = os.environ.get('FACETAG_GALLERY_PRECISION', 'float64')
+# Top candidates per probe re-scored in float64 when the gallery is compact (0 disables)
+GALLERY_RERANK = _env_int('FACETAG_GALLERY_RERANK', 8)
+# Width of newly written users.face_encoding blobs: 'float64' or 'float32'
+ENCODING_STORAGE = os.environ.get('FACETAG_ENCODING_STORAGE', 'float64')
+
+# Multi-template users: centroid shortlist size and cached template sets (see templates.py)
+TEMPLATE_SHORTLIST = _env_int('FACETAG_TEMPLATE_SHORTLIST', 10)
+TEMPLATE_CACHE_SIZE = _env_int('FACETAG_TEMPLATE_CACHE_SIZE', 10000)
+
+# Prometheus-text metrics at /api/metrics, optional Server-Timing header per response
+METRICS_ENABLED = _env_bool('FACETAG_METRICS_ENABLED', True)
+METRICS_TIMING_HEADER = _env_bool('FACETAG_METRICS_TIMING_HEADER', False)
+
+# Load the gallery and dlib models on a background thread so the server answers at once
+WARMUP_BACKGROUND = _env_bool('FACETAG_WARMUP_BACKGROUND', True)
+
+# SQLite connection pool and per-connection tuning (see db.py)
+SQLITE_POOL_SIZE = _env_int('FACETAG_SQLITE_POOL_SIZE', 8)
+SQLITE_CACHE_KB = _env_int('FACETAG_SQLITE_CACHE_KB', 16384)
+SQLITE_MMAP_BYTES = _env_int('FACETAG_SQLITE_MMAP_BYTES', 256 * 1024 * 1024)
+SQLITE_BUSY_TIMEOUT = _env_float('FACETAG_SQLITE_BUSY_TIMEOUT', 5.0)
+SQLITE_STATEMENT_CACHE = _env_int('FACETAG_SQLITE_STATEMENT_CACHE', 256)
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import config
+
+DB_PATH = 'face_recognition.db'
+
+
+def connect(db_path=DB_PATH, check_same_thread=True):
+    """
+    A tuned connection:
+      journal_mode=WAL      readers no longer wait for a registration's write
+                            transaction, and a writer doesn't wait for readers
+      synchronous=NORMAL    no fsync per commit in WAL mode (a power cut can lose
+                            the last commits, never corrupt the file)
+      cache_size, mmap_size larger page cache; pages read via mmap, not read()
+    plus a busy timeout and a bigger prepared-statement cache.
+    """
+    conn = sqlite3.connect(
+        db_path,
+        timeout=config.SQLITE_BUSY_TIMEOUT,
+        cached_statements=config.SQLITE_STATEMENT_CACHE,
+        check_same_thread=check_same_thread
+    )
+    # WAL is a property of the database file; after the first switch this is a no-op
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{config.SQLITE_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    """
+    Reusable tuned connections to one database file.
+
+    acquire() hands out an idle connection (most recently used first, so its
+    page cache is warm) or opens a new one; release() rolls back anything left
+    uncommitted and keeps up to `size` connections idle, closing the rest.
+    Connections are never shared by two threads at once, but may move between
+    threads, so they are opened with check_same_thread=False.
+    """
+
+    def __init__(self, db_path=DB_PATH, size=8):
+        self.db_path = db_path
+        self.size = size
+        self.opened = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.opened += 1
+        return connect(self.db_path, check_same_thread=False)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self._lock:
+            if not self._closed and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        with pool.connection() as conn: ...
+        Commits if the block succeeds, rolls back if it raises, and always
+        returns the connection to the pool.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        finally:
+            self.release(conn)
+
+    def idle(self):
+        with self._lock:
+            return len(self._idle)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path=DB_PATH):
+    """The process-wide pool for a database file"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(db_path, size=config.SQLITE_POOL_SIZE)
+        return pool
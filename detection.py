@@ -0,0 +1,93 @@
+import cv2
+
+from startup import lazy_import
+
+# Loads the dlib models; deferred until a face is actually detected or encoded
+face_recognition = lazy_import('face_recognition')
+
+# Smallest face dlib's HOG detector finds at number_of_times_to_upsample=1
+HOG_MIN_FACE_PX = 40
+
+
+class DetectionPolicy:
+    """
+    Chooses the resolution face detection runs at.
+
+    Modes:
+      full      - detect on the original frame
+      fixed     - always shrink by `scale` (what SimpleFacerec does with 0.25)
+      max_side  - shrink so the longest side is at most `max_side` pixels
+      adaptive  - shrink as far as possible while the smallest expected face
+                  (`min_face_px` in original pixels) stays detectable
+
+    Only detection runs on the small frame. Boxes are mapped back to original
+    coordinates and landmarks/encodings are computed on full-resolution crops,
+    so encoding accuracy is unchanged.
+    """
+
+    MODES = ('full', 'fixed', 'max_side', 'adaptive')
+
+    def __init__(self, mode='max_side', scale=0.25, max_side=640, min_face_px=120, upsample=1):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown detection mode: {mode}")
+        self.mode = mode
+        self.scale = scale
+        self.max_side = max_side
+        self.min_face_px = min_face_px
+        self.upsample = upsample
+
+    def scale_for(self, frame):
+        height, width = frame.shape[:2]
+        if self.mode == 'fixed':
+            scale = self.scale
+        elif self.mode == 'max_side':
+            scale = self.max_side / max(height, width)
+        elif self.mode == 'adaptive':
+            # Leave some headroom over the detector's minimum face size
+            scale = 1.25 * HOG_MIN_FACE_PX / self.min_face_px
+        else:
+            scale = 1.0
+        return min(scale, 1.0)
+
+    def detect(self, frame, model='hog'):
+        """Face boxes as (top, right, bottom, left) in original frame coordinates"""
+        scale = self.scale_for(frame)
+        if scale >= 1.0:
+            return face_recognition.face_locations(frame, self.upsample, model)
+
+        small = cv2.resize(frame, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        height, width = frame.shape[:2]
+        return [
+            (max(0, int(top / scale)), min(width, int(right / scale)),
+             min(height, int(bottom / scale)), max(0, int(left / scale)))
+            for top, right, bottom, left in face_recognition.face_locations(small, self.upsample, model)
+        ]
+
+
+def box_iou(a, b):
+    """IoU of two (top, right, bottom, left) boxes"""
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - inter
+    return inter / union if union > 0 else 0.0
+
+
+def encode_crops(frame, face_locations, margin=0.25):
+    """
+    128-d encodings computed on a full-resolution crop around each box, so the
+    landmark model and encoder never touch the rest of the frame
+    """
+    height, width = frame.shape[:2]
+    encodings = []
+    for top, right, bottom, left in face_locations:
+        pad_y = int((bottom - top) * margin)
+        pad_x = int((right - left) * margin)
+        y0, y1 = max(0, top - pad_y), min(height, bottom + pad_y)
+        x0, x1 = max(0, left - pad_x), min(width, right + pad_x)
+        crop = frame[y0:y1, x0:x1].copy()
+        local_box = (top - y0, right - x0, bottom - y0, left - x0)
+        encodings.extend(face_recognition.face_encodings(crop, [local_box]))
+    return encodings
@@ -0,0 +1,88 @@
+import base64
+import cv2
+import numpy as np
+
+import config
+import metrics
+from detection import DetectionPolicy, encode_crops
+from quality import FrameGate, NO_FACE
+
+# Server-side detection resolution, see detection.DetectionPolicy
+detection_policy = DetectionPolicy(
+    mode=config.DETECTION_MODE,
+    scale=config.DETECTION_SCALE,
+    max_side=config.DETECTION_MAX_SIDE,
+    min_face_px=config.DETECTION_MIN_FACE_PX
+)
+
+# Cheap presence/quality checks run before HOG detection on identify frames
+frame_gate = None
+if config.QUALITY_GATE_ENABLED:
+    frame_gate = FrameGate(
+        min_face_px=config.QUALITY_MIN_FACE_PX,
+        min_sharpness=config.QUALITY_MIN_SHARPNESS,
+        min_brightness=config.QUALITY_MIN_BRIGHTNESS,
+        max_brightness=config.QUALITY_MAX_BRIGHTNESS,
+        cascade_path=config.QUALITY_CASCADE_PATH
+    )
+
+
+@metrics.timed('base64_decode')
+def decode_base64_image(image_data):
+    """Raw image bytes from a base64 string or data URL (legacy JSON uploads)"""
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    return base64.b64decode(image_data)
+
+
+@metrics.timed('decode')
+def decode_image_bytes(image_bytes):
+    """
+    Decode JPEG/PNG bytes straight into an RGB frame, the channel order
+    face_recognition expects. One decode, no intermediate PIL/array copies:
+    the byte buffer is wrapped without copying and the BGR->RGB swap is in place.
+    """
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    frame = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if frame is None:
+        raise ValueError("Could not decode image")
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+
+
+@metrics.timed('detect')
+def detect_faces(frame, policy=None):
+    """Face boxes in original frame coordinates, detected at the policy's resolution"""
+    return (policy or detection_policy).detect(frame)
+
+
+def encode_frame(frame, policy=None):
+    """Encodings of every face found in an RGB frame"""
+    face_locations = detect_faces(frame, policy)
+    if not face_locations:
+        return []
+    with metrics.stage('encode'):
+        return encode_crops(frame, face_locations)
+
+
+def encode_image(image_bytes):
+    """Decode one encoded image and return the encodings of every face in it"""
+    return encode_frame(decode_image_bytes(image_bytes))
+
+
+def analyze_frame(frame):
+    """
+    Gated encoding for identification: frames that fail the quality gate never
+    reach dlib
+    :return: (encodings, reason) where reason is a quality.* code or None
+    """
+    if frame_gate is not None:
+        with metrics.stage('quality_gate'):
+            reason = frame_gate.check(frame)
+        if reason is not None:
+            return [], reason
+    encodings = encode_frame(frame)
+    return encodings, (None if encodings else NO_FACE)
+
+
+def analyze_image(image_bytes):
+    return analyze_frame(decode_image_bytes(image_bytes))
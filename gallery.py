@@ -0,0 +1,401 @@
+import numpy as np
+
+ENCODING_DIM = 128
+
+# face_encoding blob widths: float64 as written by face_recognition, float32 once migrated
+BLOB_DTYPES = {ENCODING_DIM * 8: np.float64, ENCODING_DIM * 4: np.float32}
+
+
+def encoding_blob(encoding, dtype='float64'):
+    """Bytes stored in users.face_encoding"""
+    return np.asarray(encoding, dtype=dtype).reshape(ENCODING_DIM).tobytes()
+
+
+def decode_encodings(blobs):
+    """
+    (N, 128) float64 matrix from face_encoding blobs of either storage width.
+    A table is read in one frombuffer call unless widths are mixed mid-migration.
+    """
+    blobs = list(blobs)
+    if not blobs:
+        return np.empty((0, ENCODING_DIM), dtype=np.float64)
+    widths = {len(blob) for blob in blobs}
+    if len(widths) == 1:
+        width = widths.pop()
+        if width not in BLOB_DTYPES:
+            raise ValueError(f"Unexpected face encoding blob of {width} bytes")
+        return np.frombuffer(b''.join(blobs), dtype=BLOB_DTYPES[width]) \
+            .reshape(-1, ENCODING_DIM).astype(np.float64, copy=False)
+    return np.vstack([decode_encodings([blob]) for blob in blobs])
+
+
+class _Storage:
+    """
+    Over-allocated row buffers shared by successive gallery generations. A newer
+    generation only ever writes past the rows an older generation can see.
+    """
+
+    def __init__(self, ids, encodings, sq_norms):
+        self.ids = ids
+        self.encodings = encodings
+        self.sq_norms = sq_norms
+        self.size = len(ids)
+
+    @classmethod
+    def allocate(cls, capacity):
+        storage = cls(
+            np.empty(capacity, dtype=np.int64),
+            np.empty((capacity, ENCODING_DIM), dtype=np.float64),
+            np.empty(capacity, dtype=np.float64)
+        )
+        storage.size = 0
+        return storage
+
+    @property
+    def capacity(self):
+        return len(self.ids)
+
+    def grow(self, size, capacity):
+        storage = _Storage.allocate(capacity)
+        storage.ids[:size] = self.ids[:size]
+        storage.encodings[:size] = self.encodings[:size]
+        storage.sq_norms[:size] = self.sq_norms[:size]
+        storage.size = size
+        return storage
+
+
+def _squared_norms(encodings):
+    return np.einsum('ij,ij->i', encodings, encodings)
+
+
+# Removed rows are only masked out; once they outnumber the live ones the
+# next removal copies the live rows into a fresh, private gallery
+MAX_DEAD_FRACTION = 0.5
+
+
+class _IdLookup:
+    """Sorted view of one segment's ids, built on first use, for id -> row lookups"""
+
+    def __init__(self, ids):
+        self.ids = ids
+        self._order = None
+        self._sorted = None
+
+    def find(self, user_ids):
+        """
+        Row of the last occurrence of each user id in the segment
+        :return: int64 array of rows, -1 where the id is absent
+        """
+        if self._sorted is None:
+            self._sorted = bool(np.all(self.ids[1:] >= self.ids[:-1]))
+            if not self._sorted:
+                self._order = np.argsort(self.ids, kind='stable')
+        if not len(self.ids):
+            return np.full(len(user_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self.ids, user_ids, side='right', sorter=self._order) - 1
+        rows = positions if self._order is None else self._order[np.maximum(positions, 0)]
+        found = (positions >= 0) & (self.ids[np.maximum(rows, 0)] == user_ids)
+        return np.where(found, rows, -1).astype(np.int64)
+
+
+class FaceGallery:
+    """
+    All known face encodings held as one contiguous (N, 128) matrix so that a
+    lookup is a single matrix product instead of a Python loop over users.
+
+    The bulk of the rows live in a read-only base segment (which may be a
+    memory-mapped snapshot shared between processes); rows registered while
+    the process is running go to a small private tail segment. Removed rows
+    stay in their segment and are masked out of every result, so a deletion
+    never copies the base.
+
+    A gallery is never modified once published: with_added / with_removed return
+    a new generation, so readers holding the old one are never disturbed.
+    """
+
+    def __init__(self, ids, encodings, sq_norms=None):
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        encodings = np.ascontiguousarray(encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        if len(ids) != len(encodings):
+            raise ValueError("ids and encodings must have the same length")
+
+        # Squared norms are fixed per row, so compute them once up front
+        if sq_norms is None:
+            sq_norms = _squared_norms(encodings)
+        self._base = (ids, encodings, np.asarray(sq_norms, dtype=np.float64))
+        self._base_lookup = _IdLookup(ids)
+        self._tail = None
+        self._tail_size = 0
+        self._dead = np.empty(0, dtype=np.int64)
+        self._reset_views()
+
+    def _reset_views(self):
+        self._joined = None
+        self._ids = None
+        self._tail_lookup = None
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int64), np.empty((0, ENCODING_DIM)))
+
+    def _derive(self, tail, tail_size, dead):
+        gallery = FaceGallery.__new__(FaceGallery)
+        gallery._base = self._base
+        gallery._base_lookup = self._base_lookup
+        gallery._tail = tail
+        gallery._tail_size = tail_size
+        gallery._dead = dead
+        gallery._reset_views()
+        return gallery
+
+    def _segments(self):
+        """(ids, encodings, sq_norms) per segment, removed rows included"""
+        yield self._base
+        if self._tail_size:
+            tail, size = self._tail, self._tail_size
+            yield tail.ids[:size], tail.encodings[:size], tail.sq_norms[:size]
+
+    def _live_masks(self):
+        """Per segment, a boolean mask of the rows still in the gallery (None when all are)"""
+        start = 0
+        for ids, _, _ in self._segments():
+            dead = self._dead[(self._dead >= start) & (self._dead < start + len(ids))] - start
+            if len(dead):
+                mask = np.ones(len(ids), dtype=bool)
+                mask[dead] = False
+                yield mask
+            else:
+                yield None
+            start += len(ids)
+
+    def _live_segments(self):
+        for segment, mask in zip(self._segments(), self._live_masks()):
+            yield segment if mask is None else tuple(column[mask] for column in segment)
+
+    def _join(self):
+        if self._joined is None:
+            if not self._tail_size and not len(self._dead):
+                self._joined = self._base
+            else:
+                self._joined = tuple(np.concatenate(parts) for parts in zip(*self._live_segments()))
+        return self._joined
+
+    @property
+    def ids(self):
+        """Live user ids in row order; only the id columns are concatenated"""
+        if self._ids is None:
+            if not self._tail_size and not len(self._dead):
+                self._ids = self._base[0]
+            else:
+                ids = np.concatenate([ids for ids, _, _ in self._segments()])
+                self._ids = np.delete(ids, self._dead)
+        return self._ids
+
+    @property
+    def encodings(self):
+        """Live rows as one matrix. Copies every segment: for offline tools, not request paths"""
+        return self._join()[1]
+
+    @property
+    def sq_norms(self):
+        return self._join()[2]
+
+    def __len__(self):
+        return len(self._base[0]) + self._tail_size - len(self._dead)
+
+    def _locate(self, user_ids):
+        """Physical row of each live user id, -1 if it is not in the gallery"""
+        user_ids = np.asarray(user_ids, dtype=np.int64).reshape(-1)
+        rows = self._base_lookup.find(user_ids)
+        if self._tail_size:
+            if self._tail_lookup is None:
+                self._tail_lookup = _IdLookup(self._tail.ids[:self._tail_size])
+            # The tail is newer than the base, so its rows win
+            tail_rows = self._tail_lookup.find(user_ids)
+            rows = np.where(tail_rows >= 0, tail_rows + len(self._base[0]), rows)
+        if len(self._dead):
+            rows[np.isin(rows, self._dead)] = -1
+        return rows
+
+    def contains(self, user_ids):
+        """Boolean mask: which of user_ids are in the gallery, without touching the encodings"""
+        return self._locate(user_ids) >= 0
+
+    def encodings_for(self, user_ids):
+        """
+        Rows of the given user ids, gathered segment by segment, so a memory-mapped
+        base only pages in the rows asked for
+        :return: (len(user_ids), 128) float64 matrix
+        """
+        rows = self._locate(user_ids)
+        if (rows < 0).any():
+            raise KeyError(f"User ids not in gallery: {np.asarray(user_ids)[rows < 0][:5].tolist()}")
+        result = np.empty((len(rows), ENCODING_DIM), dtype=np.float64)
+        base_size = len(self._base[0])
+        in_base = rows < base_size
+        result[in_base] = self._base[1][rows[in_base]]
+        if not in_base.all():
+            result[~in_base] = self._tail.encodings[rows[~in_base] - base_size]
+        return result
+
+    def blocks(self, size):
+        """
+        (ids, encodings) of the live rows in chunks of at most `size` rows,
+        segment by segment, for consumers that stream the whole gallery
+        """
+        for (ids, encodings, _), live in zip(self._segments(), self._live_masks()):
+            for start in range(0, len(ids), size):
+                block_ids, block = ids[start:start + size], encodings[start:start + size]
+                if live is not None:
+                    keep = live[start:start + size]
+                    block_ids, block = block_ids[keep], block[keep]
+                if len(block_ids):
+                    yield block_ids, block
+
+    def with_added(self, ids, encodings):
+        """New generation with extra rows appended; amortised O(rows added)"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        if not len(ids):
+            return self
+
+        size = self._tail_size
+        needed = size + len(ids)
+        storage = self._tail
+        if storage is None:
+            storage = _Storage.allocate(max(needed, 64))
+        # Appending in place is only safe from the newest generation of a buffer
+        elif storage.size != size or needed > storage.capacity:
+            storage = storage.grow(size, max(needed, 2 * size))
+
+        storage.ids[size:needed] = ids
+        storage.encodings[size:needed] = encodings
+        storage.sq_norms[size:needed] = _squared_norms(encodings)
+        storage.size = needed
+
+        return self._derive(storage, needed, self._dead)
+
+    def with_removed(self, ids):
+        """New generation without the given user ids; their rows are masked out, not copied away"""
+        ids = np.asarray(ids, dtype=np.int64)
+        dead, start = self._dead, 0
+        for segment_ids, _, _ in self._segments():
+            dead = np.union1d(dead, np.flatnonzero(np.isin(segment_ids, ids)) + start)
+            start += len(segment_ids)
+        if len(dead) == len(self._dead):
+            return self
+
+        gallery = self._derive(self._tail, self._tail_size, dead)
+        if len(dead) > MAX_DEAD_FRACTION * start:
+            return FaceGallery(*gallery._join())
+        return gallery
+
+    def subset(self, user_ids):
+        """New gallery holding only the given user ids, gathered segment by segment"""
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        parts = []
+        for (ids, encodings, sq_norms), live in zip(self._segments(), self._live_masks()):
+            keep = np.isin(ids, user_ids)
+            if live is not None:
+                keep &= live
+            parts.append((ids[keep], encodings[keep], sq_norms[keep]))
+        return FaceGallery(*(np.concatenate(columns) for columns in zip(*parts)))
+
+    def _row_distances(self, probes):
+        """(P, physical rows) distances; removed rows are +inf"""
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        probe_sq_norms = _squared_norms(probes)
+
+        rows = len(self._base[0]) + self._tail_size
+        sq_dist = np.empty((len(probes), rows), dtype=np.float64)
+        start = 0
+        for _, encodings, sq_norms in self._segments():
+            out = sq_dist[:, start:start + len(encodings)]
+            # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+            np.matmul(probes, encodings.T, out=out)
+            out *= -2.0
+            out += probe_sq_norms[:, None]
+            out += sq_norms[None, :]
+            start += len(encodings)
+
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        np.sqrt(sq_dist, out=sq_dist)
+        sq_dist[:, self._dead] = np.inf
+        return sq_dist
+
+    def distances(self, probes):
+        """
+        Euclidean distance from every probe to every gallery row
+        :param probes: (P, 128) array or a single 128-d encoding
+        :return: (P, N) distance matrix, columns in the order of `ids`
+        """
+        dist = self._row_distances(probes)
+        return np.delete(dist, self._dead, axis=1) if len(self._dead) else dist
+
+    def search(self, probes, k=1):
+        """
+        Top-k nearest gallery identities for every probe
+        :param probes: (P, 128) array or a single 128-d encoding
+        :param k: number of neighbours to return per probe
+        :return: list (one entry per probe) of [(user_id, distance), ...] sorted by distance
+        """
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        if len(self) == 0:
+            return [[] for _ in range(len(probes))]
+
+        dist = self._row_distances(probes)
+        # Removed rows sort last at +inf, so never make it into the top len(self)
+        rows = dist.shape[1]
+        k = min(k, len(self))
+        if k < rows:
+            top = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(rows), dist.shape)
+        top_dist = np.take_along_axis(dist, top, axis=1)
+        order = np.argsort(top_dist, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_dist = np.take_along_axis(top_dist, order, axis=1)
+
+        ids = self._row_ids(np.unique(top))
+        return [
+            [(ids[j], float(d)) for j, d in zip(row_idx, row_dist)]
+            for row_idx, row_dist in zip(top.tolist(), top_dist)
+        ]
+
+    def search_among(self, probe, user_ids, k=1):
+        """
+        Top-k for one probe among the given candidate ids only (e.g. from an ANN
+        index); ids no longer in the gallery are skipped
+        :return: [(user_id, distance), ...] sorted by distance
+        """
+        probe = np.asarray(probe, dtype=np.float64).reshape(ENCODING_DIM)
+        user_ids = np.asarray(user_ids, dtype=np.int64).reshape(-1)
+        user_ids = user_ids[self._locate(user_ids) >= 0]
+        if not len(user_ids):
+            return []
+        dist = np.linalg.norm(self.encodings_for(user_ids) - probe, axis=1)
+        top = np.argsort(dist)[:k]
+        return [(int(user_ids[j]), float(dist[j])) for j in top]
+
+    def _row_ids(self, rows):
+        """Map row positions to user ids without joining the segments"""
+        base_ids = self._base[0]
+        result = {}
+        for row in rows.tolist():
+            if row < len(base_ids):
+                result[row] = int(base_ids[row])
+            else:
+                result[row] = int(self._tail.ids[row - len(base_ids)])
+        return result
+
+    def best_match(self, probes, tolerance=0.6):
+        """
+        Closest gallery identity over all probes, or None if nothing is within tolerance
+        :return: (user_id, distance) or None
+        """
+        best = None
+        for neighbours in self.search(probes, k=1):
+            if neighbours and neighbours[0][1] <= tolerance:
+                if best is None or neighbours[0][1] < best[1]:
+                    best = neighbours[0]
+        return best
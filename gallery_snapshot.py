@@ -0,0 +1,237 @@
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+
+from gallery import FaceGallery, ENCODING_DIM, decode_encodings
+
+# Rows fetched from SQLite per round trip while (re)building a snapshot
+FETCH_BATCH = 10000
+
+# Rebuild instead of replaying from the database once this share of rows is newer than the snapshot
+MAX_TAIL_FRACTION = 0.1
+
+# Seconds after which an unfinished version directory counts as left behind by a crashed writer
+ABANDONED_WRITE_AGE = 3600
+
+
+def snapshot_dir_for(db_path):
+    """Snapshot lives next to the database, e.g. face_recognition.gallery/"""
+    base, _ = os.path.splitext(db_path)
+    return base + '.gallery'
+
+
+def db_stamp(conn):
+    """
+    Cheap version of the users table. User ids are AUTOINCREMENT, so any insert
+    moves max_id and any delete moves count. Adding a face template rewrites the
+    user's centroid in place, which neither would notice, so the newest
+    face_templates id is part of the stamp too.
+    """
+    count, max_id = conn.execute("SELECT COUNT(*), MAX(id) FROM users").fetchone()
+    try:
+        template_max_id = conn.execute("SELECT MAX(id) FROM face_templates").fetchone()[0]
+    except sqlite3.OperationalError:
+        template_max_id = None
+    return {'count': count, 'max_id': max_id or 0, 'template_max_id': template_max_id or 0}
+
+
+ARRAYS = ('ids', 'encodings', 'sq_norms')
+
+
+def _read_meta(snapshot_dir):
+    try:
+        with open(os.path.join(snapshot_dir, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def snapshot_version(snapshot_dir):
+    """Version named by meta.json, or None; cheap enough to poll"""
+    meta = _read_meta(snapshot_dir)
+    return meta.get('version') if meta else None
+
+
+def _remove_version(path):
+    for name in ARRAYS:
+        try:
+            os.remove(os.path.join(path, name + '.npy'))
+        except OSError:
+            pass
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def _prune_versions(snapshot_dir, keep):
+    """Drop superseded snapshot versions (and files of the old flat layout), keeping `keep`"""
+    for name in os.listdir(snapshot_dir):
+        path = os.path.join(snapshot_dir, name)
+        if name in keep or name == 'meta.json':
+            continue
+        if name.endswith('.tmp'):
+            # Another process may still be writing this one
+            try:
+                if time.time() - os.path.getmtime(path) > ABANDONED_WRITE_AGE:
+                    _remove_version(path)
+            except OSError:
+                pass
+        elif os.path.isdir(path):
+            _remove_version(path)
+        elif name.endswith('.npy'):
+            os.remove(path)
+
+
+def write_snapshot(conn, snapshot_dir):
+    """
+    Stream every encoding from the users table straight into .npy files without
+    building per-user Python objects.
+
+    Each snapshot goes into a version directory of its own whose files are
+    never touched again; meta.json, renamed into place last, names the current
+    version. A reader therefore always maps ids, encodings and norms from the
+    same write, even while another process is writing the next one.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    stamp = db_stamp(conn)
+    count = stamp['count']
+    version = f"{stamp['max_id']}-{count}-{stamp['template_max_id']}-{os.getpid()}-{time.time_ns()}"
+    version_dir = os.path.join(snapshot_dir, version)
+    # Written under a .tmp name, so a concurrent writer's pruning leaves it alone
+    tmp_dir = version_dir + '.tmp'
+    os.makedirs(tmp_dir)
+
+    paths = {name: os.path.join(tmp_dir, name + '.npy') for name in ARRAYS}
+    ids = np.lib.format.open_memmap(paths['ids'], mode='w+', dtype=np.int64, shape=(count,))
+    encodings = np.lib.format.open_memmap(
+        paths['encodings'], mode='w+', dtype=np.float64, shape=(count, ENCODING_DIM))
+    sq_norms = np.lib.format.open_memmap(paths['sq_norms'], mode='w+', dtype=np.float64, shape=(count,))
+
+    # Rows may be added while we stream; only take the ones covered by the stamp
+    cursor = conn.execute(
+        "SELECT id, face_encoding FROM users WHERE id <= ? ORDER BY id", (stamp['max_id'],))
+    row = 0
+    while row < count:
+        batch = cursor.fetchmany(FETCH_BATCH)
+        if not batch:
+            break
+        end = row + len(batch)
+        ids[row:end] = [user_id for user_id, _ in batch]
+        encodings[row:end] = decode_encodings(blob for _, blob in batch)
+        sq_norms[row:end] = np.einsum('ij,ij->i', encodings[row:end], encodings[row:end])
+        row = end
+
+    for array in (ids, encodings, sq_norms):
+        array.flush()
+    del ids, encodings, sq_norms
+
+    if row != count:
+        # Rows vanished while streaming; stamp would lie, so let the next load retry
+        _remove_version(tmp_dir)
+        return None
+    os.rename(tmp_dir, version_dir)
+
+    previous = _read_meta(snapshot_dir)
+    stamp.update({'dim': ENCODING_DIM, 'dtype': 'float64', 'created': time.time(), 'version': version})
+    meta_path = os.path.join(snapshot_dir, 'meta.json')
+    suffix = f'.{version}.tmp'
+    with open(meta_path + suffix, 'w') as f:
+        json.dump(stamp, f)
+    os.replace(meta_path + suffix, meta_path)
+
+    # The version just replaced stays for readers that read meta.json a moment
+    # ago; mappings of anything older are unaffected by the unlink
+    keep = {version}
+    if previous is not None and previous.get('version'):
+        keep.add(previous['version'])
+    _prune_versions(snapshot_dir, keep)
+    return stamp
+
+
+def open_snapshot(snapshot_dir):
+    """Memory-map a snapshot read-only; pages are shared with every other process mapping it"""
+    for _ in range(2):
+        meta = _read_meta(snapshot_dir)
+        if meta is None or meta.get('dim') != ENCODING_DIM or not meta.get('version'):
+            return None, None
+        version_dir = os.path.join(snapshot_dir, meta['version'])
+        try:
+            arrays = [np.load(os.path.join(version_dir, name + '.npy'), mmap_mode='r') for name in ARRAYS]
+        except (OSError, ValueError):
+            # Pruned between reading meta.json and opening it: read meta.json again
+            continue
+        if any(len(array) != meta['count'] for array in arrays):
+            return None, None
+        return FaceGallery(*arrays), meta
+    return None, None
+
+
+def ensure_snapshot(db_path):
+    """
+    Make sure the on-disk snapshot holds exactly the current users table, for
+    processes that map it directly instead of going through load_gallery
+    :return: snapshot directory
+    """
+    snapshot_dir = snapshot_dir_for(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        meta = _read_meta(snapshot_dir)
+        stamp = db_stamp(conn)
+        if meta is None or not meta.get('version') or \
+                any(meta.get(key, 0) != stamp[key] for key in ('count', 'max_id', 'template_max_id')):
+            if write_snapshot(conn, snapshot_dir) is None:
+                raise RuntimeError("users table changed while writing the gallery snapshot")
+    finally:
+        conn.close()
+    return snapshot_dir
+
+
+def load_gallery(db_path):
+    """
+    Gallery for db_path, from the memory-mapped snapshot when it is current.
+
+    A snapshot that only lags behind by newly registered users is used as-is and
+    the missing rows are appended from the database. Anything else (deletions,
+    a large backlog of new rows, a missing or corrupt snapshot) triggers a rebuild.
+    :return: (gallery, stamp) where stamp describes the rows the gallery holds
+    """
+    snapshot_dir = snapshot_dir_for(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        stamp = db_stamp(conn)
+        gallery, meta = open_snapshot(snapshot_dir)
+
+        if meta is not None and meta['max_id'] <= stamp['max_id'] \
+                and meta.get('template_max_id', 0) == stamp['template_max_id']:
+            cursor = conn.execute(
+                "SELECT id, face_encoding FROM users WHERE id > ? ORDER BY id", (meta['max_id'],))
+            new_rows = cursor.fetchall()
+            appended_only = meta['count'] + len(new_rows) == stamp['count']
+            small_tail = len(new_rows) <= MAX_TAIL_FRACTION * max(meta['count'], 1)
+            if appended_only and small_tail:
+                if new_rows:
+                    gallery = gallery.with_added(
+                        [user_id for user_id, _ in new_rows],
+                        decode_encodings(blob for _, blob in new_rows)
+                    )
+                return gallery, stamp
+
+        print("Gallery snapshot missing or stale, rebuilding")
+        started = time.perf_counter()
+        if write_snapshot(conn, snapshot_dir) is None:
+            raise RuntimeError("users table changed while writing the gallery snapshot")
+        gallery, meta = open_snapshot(snapshot_dir)
+        print(f"Gallery snapshot written: {meta['count']} encodings in {time.perf_counter() - started:.2f}s")
+        return gallery, meta
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    conn = sqlite3.connect('face_recognition.db')
+    stamp = write_snapshot(conn, snapshot_dir_for('face_recognition.db'))
+    conn.close()
+    print(f"Gallery snapshot written: {stamp}")
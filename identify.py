@@ -1,55 +1,59 @@
+import argparse
+import json
+import time
 import cv2
-import face_recognition
 import sqlite3
-import numpy as np
+
+from gallery import FaceGallery, decode_encodings
+from capture import PipelinedCapture
+from tracking import TrackingPipeline, run_video
 
 
 class DatabaseFaceRecognition:
     def __init__(self, db_path='face_recognition.db'):
-        self.known_face_encodings = []
-        self.known_face_metadata = []
+        self.gallery = FaceGallery.empty()
+        self.known_face_metadata = {}
         self.load_database(db_path)
 
     def load_database(self, db_path):
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
-        cursor.execute("SELECT name, age, encoding FROM users")
+        cursor.execute("SELECT id, name, age, face_encoding FROM users")
         users = cursor.fetchall()
+        conn.close()
 
+        ids = []
         for user in users:
-            name, age, db_encoding = user
-            face_encoding = np.frombuffer(db_encoding, dtype=np.float64)
-            self.known_face_encodings.append(face_encoding)
-            self.known_face_metadata.append({
+            user_id, name, age, _ = user
+            ids.append(user_id)
+            self.known_face_metadata[user_id] = {
                 'name': name,
                 'age': age
-            })
-        conn.close()
-
-    def get_user_info(self, frame, tolerance=0.6):
-        small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-        rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+            }
+        self.gallery = FaceGallery(ids, decode_encodings(user[3] for user in users))
 
-        face_locations = face_recognition.face_locations(rgb_small_frame, model="hog")
-        face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+    def identify_encoding(self, face_encoding, tolerance=0.6):
+        """Closest registered user for one encoding: (metadata, distance) or (None, None)"""
+        match = self.gallery.best_match(face_encoding, tolerance=tolerance)
+        if match is None:
+            return None, None
+        user_id, distance = match
+        return self.known_face_metadata[user_id], distance
 
-        detected_users = []
 
-        for face_encoding in face_encodings:
-            matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding, tolerance=tolerance)
-            user_info = {'name': 'Unknown', 'age': 'N/A'}
+def _draw_tracks(frame, tracks):
+    for box, name in tracks:
+        top, right, bottom, left = box
+        cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 200), 2)
+        cv2.putText(frame, name, (left, top - 10), cv2.FONT_HERSHEY_DUPLEX, 0.8, (0, 0, 200), 1)
 
-            if True in matches:
-                first_match_index = matches.index(True)
-                user_info = self.known_face_metadata[first_match_index]
-                detected_users.append(user_info)
 
-        return detected_users, [(top * 4, right * 4, bottom * 4, left * 4) for (top, right, bottom, left) in
-                                face_locations]
-
-
-def identify_user():
+def identify_user(detect_every=10, pipelined=True):
     sfr = DatabaseFaceRecognition()
+    pipeline = TrackingPipeline(sfr.identify_encoding, detect_every=detect_every)
+    if pipelined:
+        return _identify_user_pipelined(pipeline)
+
     cap = cv2.VideoCapture(0)
 
     if not cap.isOpened():
@@ -63,21 +67,21 @@ def identify_user():
         if not ret:
             break
 
-        # Get user info and face locations from the frame
-        users, face_locations = sfr.get_user_info(frame)
+        # Detection and encoding only run every few frames; tracks carry identity in between
+        tracks = pipeline.process(frame)
 
         # Draw rectangles around faces
-        for (top, right, bottom, left) in face_locations:
-            cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 200), 2)
+        _draw_tracks(frame, [(track.box, track.name) for track in tracks])
 
         # Show the frame
         cv2.imshow("Face Recognition", frame)
 
         # If we found a matching user, return their info
-        if users and users[0]['name'] != 'Unknown':
+        known = [track for track in tracks if track.identity is not None]
+        if known:
             cap.release()
             cv2.destroyAllWindows()
-            return users[0]
+            return known[0].identity
 
         # Check for ESC key
         if cv2.waitKey(1) & 0xFF == 27:
@@ -88,11 +92,69 @@ def identify_user():
     return {"name": "Unknown", "age": "N/A"}
 
 
+def _identify_user_pipelined(pipeline):
+    """Camera read, inference and display on separate threads; stale frames are dropped"""
+    def infer(frame):
+        # Snapshot the tracks; the pipeline keeps mutating them on the next frame
+        return [(track.box, track.name, track.identity) for track in pipeline.process(frame)]
+
+    runner = PipelinedCapture(0, infer)
+    if not runner.is_opened():
+        print("Error: Could not open camera")
+        return None
+
+    print("Looking for face... Press ESC to exit.")
+    runner.start()
+    user_info = {"name": "Unknown", "age": "N/A"}
+
+    try:
+        while not runner.finished:
+            latest = runner.latest(timeout=0.05)
+            if latest is not None:
+                started = time.perf_counter()
+                frame, tracks = latest
+                _draw_tracks(frame, [(box, name) for box, name, _ in tracks])
+                cv2.imshow("Face Recognition", frame)
+                runner.record_display(time.perf_counter() - started)
+
+                known = [identity for _, _, identity in tracks if identity is not None]
+                if known:
+                    user_info = known[0]
+                    break
+
+            # Check for ESC key
+            if cv2.waitKey(1) & 0xFF == 27:
+                break
+    finally:
+        runner.stop()
+        cv2.destroyAllWindows()
+        print(json.dumps(runner.stats(), indent=2))
+
+    return user_info
+
+
+def benchmark_video(path, detect_every=10, max_frames=None):
+    """Run the tracking pipeline over a recorded video and report throughput"""
+    sfr = DatabaseFaceRecognition()
+    pipeline = TrackingPipeline(sfr.identify_encoding, detect_every=detect_every)
+    return run_video(pipeline, path, max_frames=max_frames)
+
+
 if __name__ == "__main__":
-    user_info = identify_user()
-    if user_info:
-        print("\nUser Information:")
-        print(f"Name: {user_info['name']}")
-        print(f"Age: {user_info['age']}")
+    parser = argparse.ArgumentParser(description="Identify a user from the camera or a recorded video")
+    parser.add_argument('--video', help="recorded video file to process offline instead of the camera")
+    parser.add_argument('--detect-every', type=int, default=10, help="run full detection every N frames")
+    parser.add_argument('--max-frames', type=int, help="stop after this many frames (video only)")
+    parser.add_argument('--serial', action='store_true', help="read, infer and display on one thread")
+    args = parser.parse_args()
+
+    if args.video:
+        print(json.dumps(benchmark_video(args.video, args.detect_every, args.max_frames), indent=2))
     else:
-        print("No face detected or error occurred.")
\ No newline at end of file
+        user_info = identify_user(detect_every=args.detect_every, pipelined=not args.serial)
+        if user_info:
+            print("\nUser Information:")
+            print(f"Name: {user_info['name']}")
+            print(f"Age: {user_info['age']}")
+        else:
+            print("No face detected or error occurred.")
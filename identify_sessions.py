@@ -0,0 +1,160 @@
+import hashlib
+import threading
+import time
+import uuid
+import numpy as np
+
+import face_pipeline
+import metrics
+from detection import encode_crops
+from quality import NO_FACE
+
+
+def frame_digest(frame):
+    """Digest of a frame's exact pixels, to recognise a poll that re-sends the same frame"""
+    return hashlib.blake2b(np.ascontiguousarray(frame).tobytes(), digest_size=16).digest()
+
+
+class IdentifySession:
+    """Per-client state for a stream of login frames"""
+
+    def __init__(self, business=None):
+        self.id = uuid.uuid4().hex
+        self.business = business
+        self.lock = threading.Lock()
+        self.last_seen = time.monotonic()
+        self.last_digest = None
+        self.last_reason = None
+        self.candidate_id = None
+        self.streak = 0
+        self.accepted_user = None
+        self.frames = 0
+        self.encodes = 0
+
+    def vote(self, user_id):
+        """Count consecutive freshly encoded frames that agree on the same user"""
+        if user_id is not None and user_id == self.candidate_id:
+            self.streak += 1
+        else:
+            self.candidate_id = user_id
+            self.streak = 1 if user_id is not None else 0
+        return self.streak
+
+
+class IdentifySessionStore:
+    """
+    Streaming identification: a user is accepted once `required_votes`
+    consecutive frames agree. While a vote is pending every new frame is
+    encoded, since each vote has to rest on an encoding of its own; a poll
+    that re-sends exactly the previous frame is answered from the session
+    without voting, and once a user is accepted further frames cost nothing.
+    """
+
+    def __init__(self, recognizer, required_votes=3, ttl=60.0, tolerance=0.6, pool=None):
+        self.recognizer = recognizer
+        self.required_votes = required_votes
+        self.ttl = ttl
+        self.tolerance = tolerance
+        self.pool = pool
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        # dlib stages go to the worker pool when there is one
+        if self.pool is not None:
+            return self.pool.call(fn, *args)
+        return fn(*args)
+
+    def _evict_expired(self, now):
+        expired = [sid for sid, session in self._sessions.items() if now - session.last_seen > self.ttl]
+        for sid in expired:
+            del self._sessions[sid]
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self, business=None):
+        session = IdentifySession(business)
+        with self._lock:
+            self._evict_expired(session.last_seen)
+            self._sessions[session.id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_seen = time.monotonic()
+            return session
+
+    def close(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _encode(self, frame):
+        """Encoding of the largest face in the frame, or (None, reason)"""
+        if face_pipeline.frame_gate is not None:
+            reason = face_pipeline.frame_gate.check(frame)
+            if reason is not None:
+                return None, reason
+
+        boxes = self._run(face_pipeline.detect_faces, frame)
+        if not boxes:
+            return None, NO_FACE
+        # The largest face is the one standing at the kiosk
+        box = max(boxes, key=lambda b: (b[2] - b[0]) * (b[1] - b[3]))
+
+        with metrics.stage('encode'):
+            encodings = self._run(encode_crops, frame, [box])
+        if not encodings:
+            return None, NO_FACE
+        return encodings[0], None
+
+    def process_frame(self, session, frame):
+        """
+        Feed one RGB frame into a session
+        :return: dict describing the vote state, with 'user' once accepted
+        """
+        with session.lock:
+            session.frames += 1
+            if session.accepted_user is not None:
+                return self._state(session, reused=True, reason=None)
+
+            digest = frame_digest(frame)
+            if digest == session.last_digest:
+                # The same frame again adds no evidence: report, don't vote
+                return self._state(session, reused=True, reason=session.last_reason)
+            session.last_digest = digest
+
+            encoding, reason = self._encode(frame)
+            if encoding is None:
+                session.vote(None)
+                session.last_reason = reason
+                return self._state(session, reused=False, reason=reason)
+
+            session.encodes += 1
+            matches = self.recognizer.match_encodings(
+                [encoding], tolerance=self.tolerance, business=session.business)[0]
+            user, _ = matches[0] if matches else (None, None)
+            votes = session.vote(user['id'] if user else None)
+
+            if user is not None and votes >= self.required_votes:
+                session.accepted_user = user
+            session.last_reason = None if user else 'not_recognized'
+            return self._state(session, reused=False, reason=session.last_reason)
+
+    def _state(self, session, reused, reason):
+        state = {
+            'session_id': session.id,
+            'accepted': session.accepted_user is not None,
+            'votes': session.streak,
+            'required_votes': self.required_votes,
+            'reused_encoding': reused,
+            'frames': session.frames,
+            'encodes': session.encodes
+        }
+        if session.accepted_user is not None:
+            state['user'] = session.accepted_user
+        if reason is not None:
+            state['reason'] = reason
+        return state
@@ -0,0 +1,101 @@
+import argparse
+from datetime import datetime
+
+import db
+
+# Lowest total points for each tier, highest tier first, as published in
+# README.md: Bronze 0-1,000, Silver 1,001-5,000, Gold 5,000+
+TIER_THRESHOLDS = (('Gold', 5000), ('Silver', 1001), ('Bronze', 0))
+TIER_RANKS = {'Bronze': 1, 'Silver': 2, 'Gold': 3}
+
+
+def calculate_tier(total_points):
+    for tier, threshold in TIER_THRESHOLDS:
+        if total_points >= threshold:
+            return tier
+    return 'Bronze'
+
+
+def tier_rank(tier):
+    return TIER_RANKS.get(tier, 0)
+
+
+def get_summary(conn, user_id):
+    """
+    A user's running points total and tier: one primary-key read
+    :return: (total_points, tier); (0, 'Bronze') for users with no points yet
+    """
+    row = conn.execute("SELECT total_points, tier FROM user_summary WHERE user_id = ?", (user_id,)).fetchone()
+    return (row[0], row[1]) if row else (0, calculate_tier(0))
+
+
+def record_points(conn, user_id, points_change, transaction_type, description, business_name=None):
+    """
+    Append a points_history entry and move the user's summary with it, in the
+    caller's transaction (the caller commits). When the tier changes, the
+    user's cards get the new tier_status too.
+    :return: (total_points, tier) after the change
+    """
+    user_id = int(user_id)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    # The INSERT opens the write transaction first, so the summary read below
+    # can't interleave with another writer's update of the same row
+    conn.execute('''
+        INSERT INTO points_history (
+            user_id, business_name, points_change, transaction_type,
+            description, transaction_date
+        )
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, business_name, points_change, transaction_type, description, now))
+
+    row = conn.execute("SELECT total_points, tier FROM user_summary WHERE user_id = ?", (user_id,)).fetchone()
+    total_points = (row[0] if row else 0) + points_change
+    tier = calculate_tier(total_points)
+    conn.execute('''
+        INSERT INTO user_summary (user_id, total_points, tier, updated_date)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            total_points = excluded.total_points,
+            tier = excluded.tier,
+            updated_date = excluded.updated_date
+    ''', (user_id, total_points, tier, now))
+    if row is None or row[1] != tier:
+        conn.execute("UPDATE loyalty_cards SET tier_status = ? WHERE user_id = ?", (tier, user_id))
+    return total_points, tier
+
+
+def rebuild_summaries(conn):
+    """
+    Recompute every user_summary row from points_history in one grouped pass,
+    in the caller's transaction
+    :return: number of users summarised
+    """
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    totals = conn.execute('''
+        SELECT user_id, SUM(points_change) FROM points_history
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+    ''').fetchall()
+    rows = [(user_id, total or 0, calculate_tier(total or 0), now) for user_id, total in totals]
+
+    conn.execute("DELETE FROM user_summary")
+    conn.executemany(
+        "INSERT INTO user_summary (user_id, total_points, tier, updated_date) VALUES (?, ?, ?, ?)", rows)
+    # Card holders without any history are Bronze
+    conn.execute("UPDATE loyalty_cards SET tier_status = 'Bronze' WHERE user_id IS NOT NULL")
+    conn.executemany(
+        "UPDATE loyalty_cards SET tier_status = ? WHERE user_id = ?",
+        [(tier, user_id) for user_id, _, tier, _ in rows if tier != 'Bronze'])
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the per-user points and tier summary from points_history")
+    parser.add_argument('--db', default=db.DB_PATH)
+    args = parser.parse_args()
+
+    conn = db.connect(args.db)
+    with conn:
+        count = rebuild_summaries(conn)
+    conn.close()
+    print(f"Rebuilt points summary for {count} users")
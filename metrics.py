@@ -0,0 +1,192 @@
+import bisect
+import functools
+import threading
+import time
+
+# Latency histogram bucket bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+enabled = True
+
+# Stage timings of the request being handled on this thread, for the timing header
+_request = threading.local()
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f'{self.name}{_label_text(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        # Per-bucket counts are stored non-cumulatively and summed at render time
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items())
+        names = self.labels + ('le',)
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{_label_text(names, label_values + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_label_text(self.labels, label_values)} {total}')
+            lines.append(f'{self.name}_count{_label_text(self.labels, label_values)} {count}')
+        return lines
+
+
+class Gauge:
+    """Value read from a callback when metrics are scraped"""
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {value}']
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.register(Histogram(
+    'facetag_stage_seconds', 'Time spent in each recognition stage', labels=('stage',)))
+request_seconds = REGISTRY.register(Histogram(
+    'facetag_http_request_duration_seconds', 'HTTP request latency by route',
+    labels=('method', 'route', 'status')))
+identify_results = REGISTRY.register(Counter(
+    'facetag_identify_results_total', 'Identification outcomes per image (matched, not_recognized, no_face, ...)',
+    labels=('result',)))
+errors = REGISTRY.register(Counter(
+    'facetag_errors_total', 'Requests that ended in a server error, by route', labels=('route',)))
+
+
+def gauge(name, help_text, read):
+    return REGISTRY.register(Gauge(name, help_text, read))
+
+
+def record_stage(name, seconds):
+    stage_seconds.observe(seconds, name)
+    timings = getattr(_request, 'timings', None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+class stage:
+    """
+    Time a block as one recognition stage:
+
+        with metrics.stage('detect'):
+            ...
+    """
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            record_stage(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def timed(name):
+    """Decorator form of stage()"""
+    def decorate(fn):
+        # wraps() keeps the qualified name, so decorated functions still pickle to worker processes
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_stage(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def begin_request():
+    _request.timings = {}
+    _request.started = time.perf_counter()
+
+
+def end_request():
+    """
+    :return: (request seconds, {stage: seconds} measured on this thread)
+    """
+    timings = getattr(_request, 'timings', None) or {}
+    started = getattr(_request, 'started', None)
+    _request.timings = None
+    return (time.perf_counter() - started if started is not None else 0.0), timings
+
+
+def server_timing(total, timings):
+    """Server-Timing header value, durations in milliseconds"""
+    parts = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.items()]
+    parts.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(parts)
@@ -0,0 +1,265 @@
+import argparse
+import sys
+
+import db
+
+# Schema versions, applied in order. The version a database is at lives in
+# PRAGMA user_version; each migration runs in its own transaction together
+# with the version bump, so a failed upgrade leaves the previous version intact.
+# Never edit a released migration, append a new one.
+
+
+def _base_schema(conn):
+    # Tables as they existed before versioning; IF NOT EXISTS keeps old databases intact
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            age INTEGER NOT NULL,
+            email TEXT,
+            phone TEXT,
+            registered_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            image_path TEXT,
+            face_encoding BLOB NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_name ON users(name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_email ON users(email)')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS loyalty_cards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            business_name TEXT NOT NULL,
+            card_number TEXT UNIQUE,
+            points INTEGER DEFAULT 0,
+            tier_status TEXT DEFAULT 'Bronze',
+            registration_date TEXT,
+            last_used TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rewards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,          -- 'birthday', 'milestone', 'tier', 'points'
+            business_name TEXT,          -- NULL for general rewards
+            name TEXT NOT NULL,
+            description TEXT,
+            points_required INTEGER,
+            tier_required TEXT,          -- 'Bronze', 'Silver', 'Gold'
+            active BOOLEAN DEFAULT 1
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_rewards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            reward_id INTEGER,
+            claim_date TEXT,
+            expiry_date TEXT,
+            status TEXT,               -- 'claimed', 'used', 'expired'
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (reward_id) REFERENCES rewards (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS points_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            business_name TEXT,
+            points_change INTEGER,      -- Can be positive or negative
+            transaction_type TEXT,      -- 'earn', 'redeem', 'expire'
+            description TEXT,
+            transaction_date TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+
+def _face_templates(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS face_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            encoding BLOB NOT NULL,
+            image_path TEXT,
+            created_date TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_face_templates_user ON face_templates(user_id)")
+
+
+def _hot_path_indexes(conn):
+    # A member's cards, newest first (also serves plain user_id lookups and deletes)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_loyalty_cards_user ON loyalty_cards(user_id, registration_date)")
+    # Claimed-reward checks and the rewards LEFT JOIN
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_rewards_user ON user_rewards(user_id, reward_id, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_points_history_user ON points_history(user_id, transaction_date)")
+    # Active rewards within a points budget
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rewards_active_points ON rewards(active, points_required)")
+
+
+def _user_summary(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_summary (
+            user_id INTEGER PRIMARY KEY,
+            total_points INTEGER NOT NULL DEFAULT 0,
+            tier TEXT NOT NULL DEFAULT 'Bronze',
+            updated_date TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    # Sign-up bonuses used to live only in loyalty_cards.points; record them in
+    # the ledger so the summary can be rebuilt from points_history alone
+    conn.execute('''
+        INSERT INTO points_history (
+            user_id, business_name, points_change, transaction_type,
+            description, transaction_date
+        )
+        SELECT user_id, business_name, points, 'earn',
+               'Opening balance for card ' || card_number, registration_date
+        FROM loyalty_cards
+        WHERE user_id IS NOT NULL AND points > 0
+    ''')
+    from loyalty import rebuild_summaries
+    rebuild_summaries(conn)
+
+
+def _rewards_version(conn):
+    # Any write to the catalog bumps the version the in-process cache checks (see rewards_catalog.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rewards_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO rewards_version (id, version) VALUES (1, 1)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS rewards_version_{event.lower()} AFTER {event} ON rewards
+            BEGIN
+                UPDATE rewards_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+
+
+MIGRATIONS = [
+    (1, 'base schema', _base_schema),
+    (2, 'face templates', _face_templates),
+    (3, 'indexes for card, reward and points lookups', _hot_path_indexes),
+    (4, 'per-user points and tier summary', _user_summary),
+    (5, 'rewards catalog version', _rewards_version),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Queries on request paths; none of them may fall back to a full table scan.
+# Keep in step with the SQL in app.py.
+HOT_QUERIES = [
+    ('user_by_id', "SELECT id FROM users WHERE id = ?", (1,)),
+    ('cards_by_user', "SELECT * FROM loyalty_cards WHERE user_id = ? ORDER BY registration_date DESC", (1,)),
+    ('card_by_number', "SELECT id FROM loyalty_cards WHERE card_number = ?", ('0',)),
+    ('summary_by_user', "SELECT total_points, tier FROM user_summary WHERE user_id = ?", (1,)),
+    ('tier_by_user', "UPDATE loyalty_cards SET tier_status = ? WHERE user_id = ?", ('Bronze', 1)),
+    ('reward_by_id', "SELECT * FROM rewards WHERE id = ? AND active = 1", (1,)),
+    ('reward_claimed', "SELECT * FROM user_rewards WHERE user_id = ? AND reward_id = ? AND status = 'claimed'",
+     (1, 1)),
+    ('rewards_version', "SELECT version FROM rewards_version WHERE id = 1", ()),
+    ('active_rewards', "SELECT id, points_required FROM rewards WHERE active = 1 AND points_required IS NOT NULL",
+     ()),
+    ('claimed_rewards', "SELECT reward_id FROM user_rewards WHERE user_id = ? AND status != 'expired'", (1,)),
+    ('points_history_by_user', "SELECT * FROM points_history WHERE user_id = ? ORDER BY transaction_date DESC",
+     (1,)),
+    ('templates_by_user', "SELECT user_id, encoding FROM face_templates WHERE user_id IN (?) ORDER BY user_id, id",
+     (1,)),
+    ('delete_points_history', "DELETE FROM points_history WHERE user_id = ?", (1,)),
+    ('delete_user_rewards', "DELETE FROM user_rewards WHERE user_id = ?", (1,)),
+    ('delete_cards', "DELETE FROM loyalty_cards WHERE user_id = ?", (1,)),
+    ('delete_templates', "DELETE FROM face_templates WHERE user_id = ?", (1,)),
+    ('delete_summary', "DELETE FROM user_summary WHERE user_id = ?", (1,)),
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn):
+    """
+    Upgrade an open connection's database to LATEST_VERSION
+    :return: versions applied
+    """
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        if schema_version(conn) >= version:
+            continue
+        # Serialises concurrent starters (several server workers): the loser
+        # waits here, then sees the version already bumped
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            upgrade(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Schema migrated to version {version}: {description}")
+        applied.append(version)
+
+    current = schema_version(conn)
+    if current > LATEST_VERSION:
+        print(f"Warning: database schema version {current} is newer than this code ({LATEST_VERSION})")
+    return applied
+
+
+def migrate(db_path=db.DB_PATH):
+    conn = db.connect(db_path)
+    try:
+        return apply_migrations(conn)
+    finally:
+        conn.close()
+
+
+def query_plan(conn, sql, params=()):
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    """
+    :return: [(query name, plan line)] for every hot query that scans a whole table
+    """
+    problems = []
+    for name, sql, params in queries:
+        for detail in query_plan(conn, sql, params):
+            # 'SCAN t' / 'SCAN TABLE t' read every row; 'SEARCH' uses an index or the rowid
+            if detail.startswith('SCAN '):
+                problems.append((name, detail))
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upgrade the database schema to the latest version")
+    parser.add_argument('--db', default=db.DB_PATH)
+    parser.add_argument('--check', action='store_true',
+                        help="also verify that no hot-path query plan is a full table scan")
+    args = parser.parse_args()
+
+    applied = migrate(args.db)
+    conn = db.connect(args.db)
+    print(f"Schema version {schema_version(conn)}" + (f" (applied {applied})" if applied else ", up to date"))
+    if args.check:
+        problems = check_query_plans(conn)
+        for name, detail in problems:
+            print(f"SCAN in {name}: {detail}")
+        print("Query plans OK" if not problems else f"{len(problems)} hot-path queries scan a table")
+        conn.close()
+        sys.exit(1 if problems else 0)
+    conn.close()
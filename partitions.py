@@ -0,0 +1,90 @@
+import threading
+import numpy as np
+
+
+class GalleryPartitions:
+    """
+    Per-business views of the face gallery, built from loyalty_cards.
+
+    Membership (which users hold a card for which business) is loaded for every
+    business up front; it is just ids. A partition's gallery is only gathered
+    from the global gallery the first time that business is searched, so
+    memory is spent on the merchants whose kiosks are actually in use. Once
+    built, a partition follows card additions and user deletions with the same
+    copy-on-write with_added / with_removed generations as the global gallery.
+    """
+
+    def __init__(self, members=None, max_card_id=0):
+        self._members = {business: set(ids) for business, ids in (members or {}).items()}
+        self._galleries = {}
+        self.max_card_id = max_card_id
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, conn):
+        members = {}
+        max_card_id = 0
+        for card_id, user_id, business_name in conn.execute(
+                "SELECT id, user_id, business_name FROM loyalty_cards WHERE user_id IS NOT NULL"):
+            members.setdefault(business_name, set()).add(user_id)
+            max_card_id = max(max_card_id, card_id)
+        return cls(members, max_card_id)
+
+    @property
+    def businesses(self):
+        return sorted(self._members)
+
+    def member_count(self, business):
+        return len(self._members.get(business, ()))
+
+    def gallery(self, business, base_gallery):
+        """Searchable gallery of one business's members; None if it has none"""
+        gallery = self._galleries.get(business)
+        if gallery is not None:
+            return gallery
+        with self._lock:
+            gallery = self._galleries.get(business)
+            if gallery is None:
+                members = self._members.get(business)
+                if not members:
+                    return None
+                gallery = base_gallery.subset(np.fromiter(members, dtype=np.int64))
+                self._galleries[business] = gallery
+            return gallery
+
+    def add_members(self, cards, encodings):
+        """
+        :param cards: [(card_id, user_id, business_name)]
+        :param encodings: {user_id: 128-d encoding} for every user in cards
+        """
+        with self._lock:
+            for card_id, user_id, business in cards:
+                self.max_card_id = max(self.max_card_id, card_id)
+                members = self._members.setdefault(business, set())
+                if user_id in members or user_id not in encodings:
+                    continue
+                members.add(user_id)
+                gallery = self._galleries.get(business)
+                if gallery is not None:
+                    self._galleries[business] = gallery.with_added([user_id], [encodings[user_id]])
+
+    def update_users(self, encodings):
+        """Replace the encodings of users whose centroid moved, in every built partition"""
+        with self._lock:
+            for business, gallery in list(self._galleries.items()):
+                user_ids = [user_id for user_id in encodings if user_id in self._members[business]]
+                if user_ids:
+                    self._galleries[business] = gallery.with_removed(user_ids).with_added(
+                        user_ids, [encodings[user_id] for user_id in user_ids])
+
+    def remove_users(self, user_ids):
+        user_ids = set(int(user_id) for user_id in user_ids)
+        with self._lock:
+            for business, members in self._members.items():
+                gone = members & user_ids
+                if not gone:
+                    continue
+                members -= gone
+                gallery = self._galleries.get(business)
+                if gallery is not None:
+                    self._galleries[business] = gallery.with_removed(list(gone))
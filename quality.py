@@ -0,0 +1,78 @@
+import os
+import cv2
+
+# Reason codes returned to clients when a frame is rejected before dlib runs
+NO_FACE = 'no_face'
+FACE_TOO_SMALL = 'face_too_small'
+BLURRY = 'blurry'
+UNDEREXPOSED = 'underexposed'
+OVEREXPOSED = 'overexposed'
+
+DEFAULT_CASCADE = 'haarcascade_frontalface_default.xml'
+
+
+def _default_cascade_path():
+    data_dir = getattr(getattr(cv2, 'data', None), 'haarcascades', '')
+    return os.path.join(data_dir, DEFAULT_CASCADE)
+
+
+class FrameGate:
+    """
+    Cheap checks in front of HOG detection and encoding.
+
+    Exposure is judged on a thumbnail, face presence with an OpenCV Haar
+    cascade on the same thumbnail, and sharpness as the variance of the
+    Laplacian over the largest face region. A frame that fails any check is
+    rejected with a reason code; only frames that can plausibly produce a match
+    go on to the expensive stages.
+    """
+
+    def __init__(self, min_face_px=80, min_sharpness=50.0, min_brightness=40, max_brightness=220,
+                 cascade_path=None, thumbnail_side=320):
+        self.min_face_px = min_face_px
+        self.min_sharpness = min_sharpness
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.thumbnail_side = thumbnail_side
+
+        cascade_path = cascade_path or _default_cascade_path()
+        self.cascade = None
+        if os.path.exists(cascade_path):
+            self.cascade = cv2.CascadeClassifier(cascade_path)
+        else:
+            print(f"Face presence cascade not found at {cascade_path}, presence check disabled")
+
+    def check(self, frame):
+        """
+        :param frame: RGB frame
+        :return: None if the frame should go on to detection, otherwise a reason code
+        """
+        height, width = frame.shape[:2]
+        scale = min(1.0, self.thumbnail_side / max(height, width))
+        small = cv2.resize(frame, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA) \
+            if scale < 1.0 else frame
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+
+        brightness = gray.mean()
+        if brightness < self.min_brightness:
+            return UNDEREXPOSED
+        if brightness > self.max_brightness:
+            return OVEREXPOSED
+
+        if self.cascade is None:
+            region = gray
+        else:
+            # Search down to half the minimum size so "too small" can be told apart from "none"
+            min_side = max(12, int(self.min_face_px * scale / 2))
+            faces = self.cascade.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=4,
+                                                  minSize=(min_side, min_side))
+            if len(faces) == 0:
+                return NO_FACE
+            x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+            if max(w, h) / scale < self.min_face_px:
+                return FACE_TOO_SMALL
+            region = gray[y:y + h, x:x + w]
+
+        if cv2.Laplacian(region, cv2.CV_64F).var() < self.min_sharpness:
+            return BLURRY
+        return None
@@ -0,0 +1,124 @@
+import multiprocessing
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from startup import lazy_import, worker_context
+
+# Imported on first use: the parent never needs cv2 / dlib, only the workers do
+face_pipeline = lazy_import('face_pipeline')
+
+
+class PoolBusy(Exception):
+    """Raised when the recognition queue is full; callers should answer 503"""
+
+
+# Shared by the workers of one pool, inherited through the initializer
+_ready_barrier = None
+
+
+def _warm_up():
+    # First call loads the dlib detector, landmark and encoder models
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    face_pipeline.encode_frame(blank)
+    return multiprocessing.current_process().pid
+
+
+def _init_worker(barrier):
+    global _ready_barrier
+    _ready_barrier = barrier
+    _warm_up()
+
+
+def _report_ready():
+    # Held until every worker runs one of these, so each worker answers exactly once
+    _ready_barrier.wait()
+    return multiprocessing.current_process().pid
+
+
+class RecognitionPool:
+    """
+    Process pool that runs the dlib stages (detection + encoding) outside the
+    web server's interpreter, so they no longer hold its GIL.
+
+    Workers only ever receive frames and return 128-d encodings; the gallery
+    stays in the parent and is never copied into them. At most
+    `size + queue_depth` jobs are admitted at once, anything beyond that is
+    rejected with PoolBusy instead of queueing without bound.
+    """
+
+    def __init__(self, size, queue_depth=32, timeout=10.0):
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size + queue_depth)
+        context = worker_context()
+        self._executor = ProcessPoolExecutor(
+            max_workers=size, mp_context=context,
+            initializer=_init_worker, initargs=(context.Barrier(size),)
+        )
+
+    def start(self):
+        """
+        Fork every worker now and have each load its models; returns the
+        futures without waiting. Call before the process starts other threads.
+        """
+        return [self._executor.submit(_report_ready) for _ in range(self.size)]
+
+    def warm_up(self, futures=None):
+        """
+        Wait until every worker has its models loaded. Models load in the
+        initializer and the start() tasks meet at a barrier, so the `size`
+        results come from `size` distinct, ready workers.
+        :return: sorted worker pids
+        """
+        futures = self.start() if futures is None else futures
+        return sorted(future.result() for future in futures)
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PoolBusy("Recognition queue is full")
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def call(self, fn, *args):
+        """Run a picklable module-level function on a worker and wait for it"""
+        return self._submit(fn, *args).result(timeout=self.timeout)
+
+    def encode_frame(self, frame):
+        return self._submit(face_pipeline.encode_frame, frame).result(timeout=self.timeout)
+
+    def encode_image(self, image_bytes):
+        return self._submit(face_pipeline.encode_image, image_bytes).result(timeout=self.timeout)
+
+    def analyze_images(self, images):
+        """
+        Gate and encode several encoded (JPEG/PNG) images in parallel across the workers
+        :return: list of (encodings, reason) per image, see face_pipeline.analyze_frame
+        """
+        futures = []
+        try:
+            for image_bytes in images:
+                futures.append(self._submit(face_pipeline.analyze_image, image_bytes))
+        except PoolBusy:
+            for future in futures:
+                future.cancel()
+            raise
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=self.timeout))
+            except TimeoutError:
+                raise
+            except Exception as e:
+                print(f"Error processing image: {str(e)}")
+                results.append(([], 'error'))
+        return results
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,9 +1,28 @@
+import argparse
+import csv
+import json
 import cv2
 import face_recognition
 import sqlite3
 import os
+import time
 from datetime import datetime
 
+import config
+import migrations
+from bulk_encoding import EncodingCache, iter_encodings, OK
+from gallery import encoding_blob
+from gallery_snapshot import snapshot_dir_for, write_snapshot
+
+# Rows per executemany call during a bulk import
+IMPORT_BATCH_SIZE = 5000
+
+INSERT_USER = '''
+    INSERT INTO users
+    (name, age, email, phone, registered_date, image_path, face_encoding)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
 def register_user(name, age, image_path, email=None, phone=None):
     try:
         # Load and encode the face
@@ -31,7 +50,7 @@ def register_user(name, age, image_path, email=None, phone=None):
             email,
             phone,
             image_path,
-            face_encoding.tobytes()
+            encoding_blob(face_encoding, config.ENCODING_STORAGE)
         ))
         
         conn.commit()
@@ -81,5 +100,168 @@ def register_sample_users():
         else:
             print(f"Image not found: {user['image_path']}")
 
+# Accepted range for a manifest entry's age
+MAX_AGE = 150
+
+
+def _manifest_user(entry, base_dir):
+    """
+    One validated manifest entry
+    :raises ValueError: with the reason when the entry can't be imported
+    """
+    if not isinstance(entry, dict):
+        raise ValueError("is not an object")
+    missing = [field for field in ('name', 'age', 'image_path') if entry.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f"is missing {missing}")
+    try:
+        age = int(str(entry['age']).strip())
+    except ValueError:
+        raise ValueError(f"has a non-numeric age {entry['age']!r}") from None
+    if not 0 <= age <= MAX_AGE:
+        raise ValueError(f"has an out of range age {age}")
+    name = str(entry['name']).strip()
+    if not name:
+        raise ValueError("has an empty name")
+
+    image_path = str(entry['image_path'])
+    if not os.path.isabs(image_path):
+        image_path = os.path.normpath(os.path.join(base_dir, image_path))
+    return {
+        'name': name,
+        'age': age,
+        'email': entry.get('email') or None,
+        'phone': entry.get('phone') or None,
+        'image_path': image_path
+    }
+
+
+def read_manifest(manifest_path):
+    """
+    Users to import from a CSV (with a header row) or JSONL manifest. Each entry
+    needs name, age and image_path; email and phone are optional. Relative image
+    paths are resolved against the manifest's directory. Malformed entries are
+    reported and left out rather than failing the whole import.
+    :return: (users, rejected) where rejected is [(entry number, reason)]
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline='') as f:
+        if manifest_path.lower().endswith(('.jsonl', '.ndjson')):
+            entries = []
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    entries.append(None)
+        else:
+            entries = list(csv.DictReader(f))
+
+    users = []
+    rejected = []
+    seen = set()
+    for line, entry in enumerate(entries, start=1):
+        try:
+            user = _manifest_user(entry, base_dir)
+        except ValueError as e:
+            rejected.append((line, str(e) if entry is not None else "is not valid JSON"))
+            continue
+        if user['image_path'] in seen:
+            rejected.append((line, f"repeats {user['image_path']}"))
+            continue
+        seen.add(user['image_path'])
+        users.append(user)
+
+    for line, reason in rejected:
+        print(f"Manifest entry {line} {reason}, skipping")
+    return users, rejected
+
+
+def import_manifest(manifest_path, db_path='face_recognition.db', workers=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Bulk registration from a manifest.
+
+    Faces are encoded across worker processes into an encoding cache next to
+    the manifest, which is committed as it goes, before the database is
+    touched. Users are then inserted with executemany in one short
+    transaction, so the write lock is never held while images are encoded and
+    an interrupted import leaves the users table untouched. Running it again
+    re-encodes nothing that was already done, and skips images that an
+    earlier complete run already registered. The gallery snapshot is
+    rewritten once at the end.
+    :return: import statistics
+    """
+    started = time.perf_counter()
+    users, rejected = read_manifest(manifest_path)
+
+    migrations.migrate(db_path)
+    conn = sqlite3.connect(db_path)
+    registered = {row[0] for row in conn.execute("SELECT image_path FROM users WHERE image_path IS NOT NULL")}
+    todo = [user for user in users if user['image_path'] not in registered]
+    print(f"{len(users)} users in manifest, {len(users) - len(todo)} already registered, {len(todo)} to import")
+
+    cache = EncodingCache(os.path.splitext(manifest_path)[0] + '.encodings_cache.db')
+    encode_stats = {}
+    skipped = []
+    rows = []
+    registered_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        by_path = {user['image_path']: user for user in todo}
+        for image_path, status, encoding in iter_encodings(
+                list(by_path), cache=cache, workers=workers, stats=encode_stats):
+            if status != OK:
+                skipped.append((image_path, status))
+                continue
+            user = by_path[image_path]
+            rows.append((user['name'], user['age'], user['email'], user['phone'],
+                         registered_date, image_path, encoding_blob(encoding, config.ENCODING_STORAGE)))
+    except BaseException:
+        conn.close()
+        raise
+    finally:
+        cache.close()
+
+    try:
+        conn.execute('BEGIN')
+        for start in range(0, len(rows), batch_size):
+            conn.executemany(INSERT_USER, rows[start:start + batch_size])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        conn.close()
+        raise
+    inserted = len(rows)
+
+    for image_path, status in skipped:
+        print(f"Skipped {image_path}: {status}")
+
+    # One snapshot rewrite for the whole import instead of one gallery update per user
+    if inserted:
+        write_snapshot(conn, snapshot_dir_for(db_path))
+    conn.close()
+
+    stats = {
+        'manifest_users': len(users),
+        'invalid_entries': len(rejected),
+        'already_registered': len(users) - len(todo),
+        'inserted': inserted,
+        'skipped': len(skipped),
+        'encoding': encode_stats,
+        'seconds': round(time.perf_counter() - started, 3)
+    }
+    print(f"Imported {inserted} users in {stats['seconds']}s ({len(skipped)} skipped, {len(rejected)} invalid)")
+    return stats
+
+
 if __name__ == "__main__":
-    register_sample_users()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Register users")
+    parser.add_argument('--manifest', help="CSV or JSONL file of users (name, age, image_path, email, phone)")
+    parser.add_argument('--workers', type=int, help="encoding processes (default: all cores)")
+    parser.add_argument('--db', default='face_recognition.db')
+    args = parser.parse_args()
+
+    if args.manifest:
+        print(json.dumps(import_manifest(args.manifest, db_path=args.db, workers=args.workers), indent=2))
+    else:
+        register_sample_users()
@@ -0,0 +1,97 @@
+import bisect
+import threading
+
+from loyalty import TIER_RANKS, tier_rank
+
+REWARD_COLUMNS = ('id', 'type', 'business_name', 'name', 'description', 'points_required', 'tier_required')
+
+
+def catalog_version(conn):
+    """Bumped by triggers on every insert, update or delete in rewards (migration 5)"""
+    row = conn.execute("SELECT version FROM rewards_version WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
+def _sort_key(reward):
+    return reward['points_required'], reward['id']
+
+
+class CatalogSnapshot:
+    """
+    The active rewards at one catalog version, indexed for eligibility:
+    for every tier rank, the rewards that rank may claim, grouped by business
+    and sorted by points_required, with the thresholds alongside for bisect.
+    """
+
+    def __init__(self, version, rewards):
+        self.version = version
+        self.by_id = {reward['id']: reward for reward in rewards}
+        self.by_tier = {}
+        for rank in sorted(set(TIER_RANKS.values())):
+            buckets = {}
+            for reward in sorted(rewards, key=_sort_key):
+                # Same rules as the SQL this replaces: no tier requirement is
+                # open to everyone, an unknown tier or missing points never matches
+                required = 0 if reward['tier_required'] is None else TIER_RANKS.get(reward['tier_required'])
+                if required is None or required > rank:
+                    continue
+                buckets.setdefault(reward['business_name'], []).append(reward)
+            self.by_tier[rank] = {
+                business: ([reward['points_required'] for reward in bucket], bucket)
+                for business, bucket in buckets.items()
+            }
+
+    @classmethod
+    def load(cls, conn):
+        # Version first: a change committed while the rows are read leaves an
+        # older version on the snapshot, so the next check simply reloads
+        version = catalog_version(conn)
+        rows = conn.execute(f'''
+            SELECT {', '.join(REWARD_COLUMNS)} FROM rewards
+            WHERE active = 1 AND points_required IS NOT NULL
+        ''').fetchall()
+        return cls(version, [dict(zip(REWARD_COLUMNS, row)) for row in rows])
+
+    def eligible(self, tier, total_points, claimed_ids=()):
+        """
+        Active rewards a member of `tier` with `total_points` can still claim,
+        cheapest first: one binary search per business, then drop claimed ids
+        """
+        found = []
+        for thresholds, bucket in self.by_tier.get(tier_rank(tier), {}).values():
+            found.extend(bucket[:bisect.bisect_right(thresholds, total_points)])
+        if claimed_ids:
+            found = [reward for reward in found if reward['id'] not in claimed_ids]
+        found.sort(key=_sort_key)
+        return found
+
+
+class RewardsCatalog:
+    """
+    In-process copy of the rewards catalog. Each use costs one primary-key
+    read of the catalog version; the rewards are only re-read after the
+    version moved (add_rewards.py rewriting the catalog, an admin edit, ...).
+    Snapshots are immutable and swapped in whole, so readers never lock.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def current(self, conn):
+        version = catalog_version(conn)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.version != version:
+                snapshot = self._snapshot = CatalogSnapshot.load(conn)
+                self.loads += 1
+            return snapshot
+
+    def eligible(self, conn, user_id, tier, total_points):
+        claimed = {reward_id for reward_id, in conn.execute(
+            "SELECT reward_id FROM user_rewards WHERE user_id = ? AND status != 'expired'", (user_id,))}
+        return self.current(conn).eligible(tier, total_points, claimed)
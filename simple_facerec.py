@@ -1,9 +1,12 @@
 import face_recognition
 import cv2
 import os
-import glob
+import time
 import numpy as np
 
+from bulk_encoding import encode_directory, OK
+from capture import PipelinedCapture
+
 class SimpleFacerec:
     def __init__(self):
         self.known_face_encodings = []
@@ -12,32 +15,36 @@ class SimpleFacerec:
         # Resize frame for a faster speed
         self.frame_resizing = 0.25
 
-    def load_encoding_images(self, images_path):
+    def load_encoding_images(self, images_path, workers=None, use_cache=True):
         """
-        Load encoding images from path
+        Load encoding images from path, encoding across a process pool. Encodings
+        are cached next to the images, so unchanged files are not re-encoded.
+        Images without exactly one face are skipped and reported.
         :param images_path:
-        :return:
+        :param workers: number of encoding processes, defaults to every core
+        :param use_cache:
+        :return: load statistics
         """
-        # Load Images
-        images_path = glob.glob(os.path.join(images_path, "*.*"))
+        results, stats = encode_directory(images_path, workers=workers, use_cache=use_cache)
 
-        print("{} encoding images found.".format(len(images_path)))
+        print("{} encoding images found.".format(stats['images']))
 
         # Store image encoding and names
-        for img_path in images_path:
-            img = cv2.imread(img_path)
-            rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        for img_path, status, img_encoding in results:
+            if status != OK:
+                print("Skipping {}: {}".format(img_path, status))
+                continue
 
             # Get the filename only from the initial file path.
             basename = os.path.basename(img_path)
             (filename, ext) = os.path.splitext(basename)
-            # Get encoding
-            img_encoding = face_recognition.face_encodings(rgb_img)[0]
 
             # Store file name and file encoding
             self.known_face_encodings.append(img_encoding)
             self.known_face_names.append(filename)
-        print("Encoding images loaded")
+        print("Encoding images loaded: {loaded} loaded, {skipped} skipped, {cached} from cache, "
+              "{encoded} encoded in {seconds}s".format(**stats))
+        return stats
 
     def detect_known_faces(self, frame):
         small_frame = cv2.resize(frame, (0, 0), fx=self.frame_resizing, fy=self.frame_resizing)
@@ -68,4 +75,38 @@ class SimpleFacerec:
         # Convert to numpy array to adjust coordinates with frame resizing quickly
         face_locations = np.array(face_locations)
         face_locations = face_locations / self.frame_resizing
-        return face_locations.astype(int), face_names
\ No newline at end of file
+        return face_locations.astype(int), face_names
+
+    def watch(self, source=0, window_name="Frame"):
+        """
+        Live recognition with capture, inference and display on separate threads,
+        so slow inference drops stale frames instead of lagging behind the camera
+        :param source: camera index, stream URL or video file
+        :return: per-stage timing statistics
+        """
+        runner = PipelinedCapture(source, self.detect_known_faces)
+        if not runner.is_opened():
+            print("Error: Could not open video source {}".format(source))
+            return None
+        runner.start()
+
+        try:
+            while not runner.finished:
+                latest = runner.latest(timeout=0.05)
+                if latest is not None:
+                    started = time.perf_counter()
+                    frame, (face_locations, face_names) = latest
+                    for face_loc, name in zip(face_locations, face_names):
+                        y1, x2, y2, x1 = face_loc[0], face_loc[1], face_loc[2], face_loc[3]
+                        cv2.putText(frame, name, (x1, y1 - 10), cv2.FONT_HERSHEY_DUPLEX, 1, (0, 0, 200), 2)
+                        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 200), 4)
+                    cv2.imshow(window_name, frame)
+                    runner.record_display(time.perf_counter() - started)
+
+                if cv2.waitKey(1) & 0xFF == 27:
+                    break
+        finally:
+            runner.stop()
+            cv2.destroyAllWindows()
+
+        return runner.stats()
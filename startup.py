@@ -0,0 +1,118 @@
+import importlib
+import multiprocessing
+import threading
+import time
+import traceback
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access.
+
+    cv2 and face_recognition (which loads the dlib models at import time)
+    take seconds to import; code that merely might need them can hold one of
+    these instead and pay for the import only when it is actually used.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            # import_module takes the import lock, concurrent first uses are safe
+            module = self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    @property
+    def loaded(self):
+        return self.__dict__['_module'] is not None
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+def worker_context():
+    """
+    multiprocessing context for worker pools: fork keeps worker start-up cheap
+    and avoids re-importing the parent's modules in every worker; spawn where
+    fork doesn't exist
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+
+
+class WarmUp:
+    """
+    Named start-up steps run one after another, by default on a daemon thread
+    so the process can serve requests that don't need them in the meantime.
+
+    States: 'pending' -> 'warming_up' -> 'ready' (or 'failed', with the error).
+    Each step's duration and the total time to ready are kept for the
+    readiness endpoint.
+    """
+
+    def __init__(self, name='warm-up'):
+        self.name = name
+        self.state = 'pending'
+        self.error = None
+        self.steps = []
+        self.step_seconds = {}
+        self.current_step = None
+        self.started = time.perf_counter()
+        self.time_to_ready = None
+        self._done = threading.Event()
+
+    def step(self, name, fn):
+        self.steps.append((name, fn))
+        return self
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def _run(self):
+        self.state = 'warming_up'
+        for name, fn in self.steps:
+            self.current_step = name
+            step_started = time.perf_counter()
+            try:
+                fn()
+            except Exception as e:
+                traceback.print_exc()
+                self.error = f"{name}: {e}"
+                self.state = 'failed'
+                print(f"{self.name} failed during '{name}': {e}")
+                self._done.set()
+                return
+            self.step_seconds[name] = round(time.perf_counter() - step_started, 4)
+        self.current_step = None
+        self.time_to_ready = round(time.perf_counter() - self.started, 4)
+        self.state = 'ready'
+        self._done.set()
+        print(f"{self.name} ready in {self.time_to_ready:.2f}s {self.step_seconds}")
+
+    def start(self, background=True):
+        if background:
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+        else:
+            self._run()
+        return self
+
+    def wait(self, timeout=None):
+        """Block until the warm-up finished (either way); True if it is ready"""
+        self._done.wait(timeout)
+        return self.ready
+
+    def status(self):
+        return {
+            'status': self.state,
+            'ready': self.ready,
+            'current_step': self.current_step,
+            'steps': dict(self.step_seconds),
+            'time_to_ready_seconds': self.time_to_ready,
+            'waiting_seconds': None if self._done.is_set() else round(time.perf_counter() - self.started, 4),
+            'error': self.error
+        }
@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+import db
+from gallery import ENCODING_DIM, decode_encodings, encoding_blob
+
+
+def add_template(conn, user_id, encoding, image_path=None, storage='float64'):
+    """
+    Store one more face template for a user and move the user's centroid
+    (users.face_encoding, which the gallery searches) to the mean of all of
+    them. A user registered before templates existed gets their registration
+    encoding backfilled as the first template. Runs in one transaction.
+    :return: (centroid, template count), or (None, 0) if the user does not exist
+    """
+    with conn:
+        row = conn.execute("SELECT face_encoding, image_path FROM users WHERE id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None, 0
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        existing = conn.execute("SELECT COUNT(*) FROM face_templates WHERE user_id = ?", (user_id,)).fetchone()[0]
+        if not existing:
+            conn.execute(
+                "INSERT INTO face_templates (user_id, encoding, image_path, created_date) VALUES (?, ?, ?, ?)",
+                (user_id, row[0], row[1], now))
+        conn.execute(
+            "INSERT INTO face_templates (user_id, encoding, image_path, created_date) VALUES (?, ?, ?, ?)",
+            (user_id, encoding_blob(encoding, storage), image_path, now))
+
+        templates = decode_encodings(
+            blob for blob, in conn.execute("SELECT encoding FROM face_templates WHERE user_id = ?", (user_id,)))
+        centroid = templates.mean(axis=0)
+        conn.execute("UPDATE users SET face_encoding = ? WHERE id = ?", (encoding_blob(centroid, storage), user_id))
+    return centroid, len(templates)
+
+
+class TemplateStore:
+    """
+    Second stage of the matching cascade.
+
+    The gallery (and ANN index, partitions, compact forms) only ever holds one
+    centroid per user, so the first pass costs the same however many photos a
+    user has. This store re-scores the shortlisted users that have several
+    templates: their distance becomes the distance to the closest template.
+    Only the ids of multi-template users are kept resident; their templates
+    are read by primary key when shortlisted and kept in a small LRU cache.
+    """
+
+    def __init__(self, db_path, cache_size=10000):
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.max_template_id = 0
+        self._multi = frozenset()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, conn):
+        rows = conn.execute(
+            "SELECT user_id FROM face_templates GROUP BY user_id HAVING COUNT(*) > 1").fetchall()
+        max_id = conn.execute("SELECT MAX(id) FROM face_templates").fetchone()[0]
+        with self._lock:
+            self._multi = frozenset(user_id for user_id, in rows)
+            self._cache.clear()
+            self.max_template_id = max_id or 0
+
+    def __len__(self):
+        return len(self._multi)
+
+    def changed(self, conn):
+        """Users whose templates were added by anyone since the last check"""
+        rows = conn.execute(
+            "SELECT id, user_id FROM face_templates WHERE id > ?", (self.max_template_id,)).fetchall()
+        if not rows:
+            return []
+        user_ids = sorted({user_id for _, user_id in rows})
+        counts = conn.execute(
+            f"SELECT user_id, COUNT(*) FROM face_templates WHERE user_id IN ({','.join('?' * len(user_ids))}) "
+            "GROUP BY user_id", user_ids).fetchall()
+        with self._lock:
+            self.max_template_id = max(self.max_template_id, max(template_id for template_id, _ in rows))
+            multi = {user_id for user_id, count in counts if count > 1}
+            self._multi = (self._multi - set(user_ids)) | multi
+            for user_id in user_ids:
+                self._cache.pop(user_id, None)
+        return user_ids
+
+    def forget(self, user_ids):
+        with self._lock:
+            self._multi = self._multi - set(int(user_id) for user_id in user_ids)
+            for user_id in user_ids:
+                self._cache.pop(int(user_id), None)
+
+    def _templates(self, user_ids):
+        found = {}
+        missing = []
+        with self._lock:
+            for user_id in user_ids:
+                if user_id in self._cache:
+                    self._cache.move_to_end(user_id)
+                    found[user_id] = self._cache[user_id]
+                else:
+                    missing.append(user_id)
+        if not missing:
+            return found
+
+        with db.get_pool(self.db_path).connection() as conn:
+            rows = conn.execute(
+                f"SELECT user_id, encoding FROM face_templates WHERE user_id IN ({','.join('?' * len(missing))}) "
+                "ORDER BY user_id, id", missing).fetchall()
+
+        loaded = {}
+        for user_id, blob in rows:
+            loaded.setdefault(user_id, []).append(blob)
+        with self._lock:
+            for user_id, blobs in loaded.items():
+                found[user_id] = self._cache[user_id] = decode_encodings(blobs)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return found
+
+    def rescore(self, probes, shortlist, k=1):
+        """
+        :param probes: (P, 128) encodings
+        :param shortlist: per probe [(user_id, centroid distance), ...] from the first pass
+        :return: per probe the k closest [(user_id, distance), ...] after the template pass
+        """
+        multi = self._multi
+        wanted = {user_id for row in shortlist for user_id, _ in row if user_id in multi}
+        if not wanted:
+            return [row[:k] for row in shortlist]
+
+        templates = self._templates(sorted(wanted))
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_DIM)
+        rescored = []
+        for probe, row in zip(probes, shortlist):
+            scored = []
+            for user_id, distance in row:
+                if user_id in templates:
+                    distance = float(np.linalg.norm(templates[user_id] - probe, axis=1).min())
+                scored.append((user_id, distance))
+            scored.sort(key=lambda item: item[1])
+            rescored.append(scored[:k])
+        return rescored
@@ -0,0 +1,186 @@
+import time
+import cv2
+import numpy as np
+
+from detection import DetectionPolicy, box_iou, encode_crops
+
+
+class FaceTrack:
+    """One face followed across frames; identity is resolved once and kept"""
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.points = None
+        self.confidence = 1.0
+        self.identity = None
+        self.distance = None
+        self.encode_calls = 0
+        self.frames = 0
+        self.missed_detections = 0
+
+    @property
+    def name(self):
+        return self.identity['name'] if self.identity else 'Unknown'
+
+
+class TrackingPipeline:
+    """
+    Detect-then-track loop for camera streams.
+
+    Full HOG detection runs every `detect_every` frames, or sooner when any
+    track's optical-flow confidence drops below `min_confidence`. In between,
+    faces are followed with pyramidal Lucas-Kanade flow on corner features
+    inside each box. A track is encoded when it is created and re-encoded only
+    while it is still unidentified (at most every `retry_every` detections),
+    so a known face costs one 128-d encoding instead of one per frame.
+
+    :param identify: callable(encoding) -> (metadata or None, distance or None)
+    """
+
+    def __init__(self, identify, detect_every=10, min_confidence=0.5, retry_every=3,
+                 detect_scale=0.25, max_missed=2):
+        self.identify = identify
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+        self.retry_every = retry_every
+        self.policy = DetectionPolicy(mode='fixed', scale=detect_scale)
+        self.max_missed = max_missed
+        self.tracks = []
+        self.frame_index = 0
+        self.detect_calls = 0
+        self.closed_tracks = []
+        self._next_track_id = 1
+        self._prev_gray = None
+
+    def _detect(self, rgb):
+        self.detect_calls += 1
+        return self.policy.detect(rgb)
+
+    def _seed_points(self, gray, track):
+        top, right, bottom, left = track.box
+        mask = np.zeros_like(gray)
+        mask[top:bottom, left:right] = 255
+        track.points = cv2.goodFeaturesToTrack(gray, maxCorners=40, qualityLevel=0.01,
+                                               minDistance=5, mask=mask)
+        track.confidence = 1.0 if track.points is not None else 0.0
+
+    def _flow(self, gray):
+        height, width = gray.shape[:2]
+        for track in self.tracks:
+            if track.points is None or self._prev_gray is None:
+                track.confidence = 0.0
+                continue
+            new_points, status, _ = cv2.calcOpticalFlowPyrLK(self._prev_gray, gray, track.points, None)
+            good = status.reshape(-1) == 1
+            track.confidence = float(good.mean()) if len(good) else 0.0
+            if not good.any():
+                track.points = None
+                continue
+            dx, dy = np.median((new_points[good] - track.points[good]).reshape(-1, 2), axis=0)
+            top, right, bottom, left = track.box
+            track.box = (
+                int(np.clip(top + dy, 0, height)), int(np.clip(right + dx, 0, width)),
+                int(np.clip(bottom + dy, 0, height)), int(np.clip(left + dx, 0, width))
+            )
+            track.points = new_points[good].reshape(-1, 1, 2)
+
+    def _encode(self, rgb, track):
+        encodings = encode_crops(rgb, [track.box])
+        track.encode_calls += 1
+        if encodings:
+            track.identity, track.distance = self.identify(encodings[0])
+
+    def _associate(self, rgb, gray, boxes):
+        unmatched = list(range(len(boxes)))
+        for track in self.tracks:
+            best, best_iou = None, 0.3
+            for i in unmatched:
+                iou = box_iou(track.box, boxes[i])
+                if iou > best_iou:
+                    best, best_iou = i, iou
+            if best is None:
+                track.missed_detections += 1
+                continue
+            unmatched.remove(best)
+            track.box = boxes[best]
+            track.missed_detections = 0
+            self._seed_points(gray, track)
+            if track.identity is None and self.detect_calls % self.retry_every == 0:
+                self._encode(rgb, track)
+
+        for track in [t for t in self.tracks if t.missed_detections > self.max_missed]:
+            self.tracks.remove(track)
+            self.closed_tracks.append(track)
+
+        for i in unmatched:
+            track = FaceTrack(self._next_track_id, boxes[i])
+            self._next_track_id += 1
+            self._seed_points(gray, track)
+            self._encode(rgb, track)
+            self.tracks.append(track)
+
+    def process(self, frame):
+        """
+        Advance the pipeline by one BGR camera frame
+        :return: list of active FaceTrack
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self._flow(gray)
+
+        needs_detection = (
+            self.frame_index % self.detect_every == 0
+            or any(track.confidence < self.min_confidence for track in self.tracks)
+        )
+        if needs_detection:
+            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            self._associate(rgb, gray, self._detect(rgb))
+
+        for track in self.tracks:
+            track.frames += 1
+        self._prev_gray = gray
+        self.frame_index += 1
+        return self.tracks
+
+    def all_tracks(self):
+        return self.closed_tracks + self.tracks
+
+
+def run_video(pipeline, path, max_frames=None):
+    """
+    Run a pipeline over a recorded video file, headless
+    :return: report dict with throughput and per-track encode counts
+    """
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open video: {path}")
+
+    started = time.perf_counter()
+    frames = 0
+    while max_frames is None or frames < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        pipeline.process(frame)
+        frames += 1
+    cap.release()
+    elapsed = time.perf_counter() - started
+
+    tracks = pipeline.all_tracks()
+    return {
+        'video': path,
+        'frames': frames,
+        'seconds': round(elapsed, 3),
+        'fps': round(frames / elapsed, 2) if elapsed > 0 else 0.0,
+        'detect_calls': pipeline.detect_calls,
+        'encode_calls': sum(track.encode_calls for track in tracks),
+        'tracks': [
+            {
+                'track_id': track.id,
+                'name': track.name,
+                'frames': track.frames,
+                'encode_calls': track.encode_calls
+            }
+            for track in tracks
+        ]
+    }